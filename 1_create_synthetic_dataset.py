@@ -1,20 +1,43 @@
-import argparse, os, json, shutil, random
+import argparse, os, json, shutil, random, threading
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
-import cv2
 
 from _utils import (
-    _load_json_file,
-    _box_around_polygon,
-    _generate_YOLO_annotations,
-    _box_within_box,
+    _load_annotation_index,
+    _open_annotation_index,
+    _image_polygon_points,
+    _boxes_around_polygon_points,
+    _scale_boxes,
+    _crop_free_space,
+    _sample_free_crops,
+    _plan_cover_crops,
+    _generate_YOLO_annotations_for_crops,
     _create_YOLO_directory,
-    _save_text_file,
-    _save_image,
+    _add_writer_arguments,
+    _add_dataset_format_arguments,
+    _encode_image,
+    _DatasetWriter,
+    _report_failed_writes,
+    _open_raw_data,
+    _render_tasks,
+    _hash_inputs,
+    _outputs_exist,
+    _remove_outputs,
+    _Manifest,
+    _image_seed,
+    _add_profile_arguments,
+    _enable_profiler,
+    _report_profile,
+    PROFILER,
+    IMAGE_FORMATS,
+    _resize_windows,
 )
 
 SCALES = [0.66666, 1.0, 1.33333]
 TARGET_WIDTH = 640
 TARGET_HEIGHT = 640
+PLANNERS = ["random", "cover"]
 
 def _parse_arguments() -> dict:
 
@@ -22,7 +45,7 @@ def _parse_arguments() -> dict:
 
     parser.add_argument(
         "-i", "--input",
-        help="Directory of raw synthetic data (default: raw_synthetic_data)",
+        help="Directory, or .zip or .tar archive, of raw synthetic data (default: raw_synthetic_data)",
         default="raw_synthetic_data"
     )
 
@@ -38,169 +61,328 @@ def _parse_arguments() -> dict:
         action="store_true"
     )
 
+    parser.add_argument(
+        "--negatives",
+        help="Number of distinct negative images per image and scale (default: one per crop with crocodiles)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--planner",
+        help="How the crops are placed: random draws one random crop around every crocodile, cover places as few crops as possible so that every crocodile is fully inside at least one (default: random)",
+        choices=PLANNERS,
+        default="random",
+    )
+
+    parser.add_argument(
+        "--max_appearances",
+        help="Number of cover crops a crocodile may be fully inside before other crops avoid it (default: 2)",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes used to generate the dataset (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "-s", "--seed",
+        help="Master seed from which every image's random generator is derived (default: random)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "-r", "--resume",
+        help="Keep the existing output and only regenerate crops whose inputs changed or that are missing",
+        action="store_true"
+    )
+
+    _add_writer_arguments(parser)
+    _add_dataset_format_arguments(parser)
+    _add_profile_arguments(parser)
+
     args = vars(parser.parse_args())
+
+    _enable_profiler(args)
     
     args["input"] = os.path.abspath(args["input"])
     args["output"] = os.path.abspath(args["output"])
+    args["workers"] = max(1, args["workers"])
+    args["max_appearances"] = max(1, args["max_appearances"])
 
     if not os.path.exists(args["input"]) :
         print(f"Input directory - {args['input']} - does not exist")
         exit()
 
-    _create_YOLO_directory(args["output"])
+    if args["resume"] and args["output_format"] == "shards":
+        print("Resuming is only supported for the directory output format")
+        exit()
+
+    _create_YOLO_directory(args["output"], args["output_format"], clean=not args["resume"])
 
     return args
 
-def _sample_from_annotation(image: np.ndarray, annotations: dict, image_filename: str, idx : int, scale: int) -> tuple:
-    
-    image_data: dict = annotations[image_filename]
-    polygons = image_data["polygons"]
+def _sample_crops(boxes: np.ndarray, scaled_size: tuple, rng: random.Random) -> np.ndarray:
+
+    width, height = scaled_size
+
+    crops = []
+
+    for left, top, right, bottom in boxes.tolist():
 
-    image, polygons = _scale_image_and_polygons(image, polygons, scale)
+        crop_left = rng.randint(max(right - TARGET_WIDTH, 0), min(left, width - TARGET_WIDTH ))
+        crop_top = rng.randint(max(bottom - TARGET_HEIGHT, 0), min(top, height - TARGET_HEIGHT ))
+
+        crops.append([crop_left, crop_top, crop_left + TARGET_WIDTH, crop_top + TARGET_HEIGHT])
+
+    return np.array(crops, dtype=np.int64).reshape(-1, 4)
+
+def _scaled_size(image: np.ndarray, scale: float) -> tuple:
 
     height = image.shape[0]
     width = image.shape[1]
 
-    target_polygon = polygons[idx]
+    return int(width*scale), int(height*scale)
 
-    left, top, right, bottom = _box_around_polygon(target_polygon)
+def _generate_samples(img: np.ndarray, boxes: np.ndarray, image_filename: str, rng: random.Random, program_arguments: dict, keep=None):
 
-    crop_left = random.randint(max(right - TARGET_WIDTH, 0), min(left, width - TARGET_WIDTH ))
-    crop_top = random.randint(max(bottom - TARGET_HEIGHT, 0), min(top, height - TARGET_HEIGHT ))
-    crop_right = crop_left + TARGET_WIDTH
-    crop_bottom = crop_top + TARGET_HEIGHT
+    counter = 0
 
-    cropped_image = image[crop_top:crop_bottom,crop_left:crop_right,:]
+    for scale in SCALES:
 
-    all_boxes = []
+        scaled_size = _scaled_size(img, scale)
+        scaled_boxes = _scale_boxes(boxes, scale)
 
-    for poly in polygons:
+        with PROFILER.span("crop selection"):
 
-        box = _box_around_polygon(poly)
-        contained_box = _box_within_box(box, [crop_left, crop_top, crop_right, crop_bottom])
+            if program_arguments["planner"] == "cover":
+                crops = _plan_cover_crops(scaled_boxes, scaled_size, (TARGET_WIDTH, TARGET_HEIGHT), program_arguments["max_appearances"], rng)
+            else:
+                crops = _sample_crops(scaled_boxes, scaled_size, rng)
 
-        if contained_box != None:
-            all_boxes.append(contained_box)
+        with PROFILER.span("labels"):
+            crop_annotations = _generate_YOLO_annotations_for_crops(scaled_boxes, crops, [TARGET_WIDTH, TARGET_HEIGHT])
 
-    image_annotations = _generate_YOLO_annotations(all_boxes, [TARGET_WIDTH, TARGET_HEIGHT])
+        windows = crops.tolist()
+        annotations = list(crop_annotations)
 
-    return cropped_image, image_annotations
+        PROFILER.count("crops", len(crops))
 
-def _negative_sample_from_annotation(image: np.ndarray, annotations: dict, image_filename: str, idx : int, scale: int, num_attempts = 100) -> tuple:
-    
-    image_data: dict = annotations[image_filename]
-    polygons = image_data["polygons"]
+        if program_arguments["negative"]:
 
-    image, polygons = _scale_image_and_polygons(image, polygons, scale)
+            negative_count = program_arguments["negatives"]
 
-    height = image.shape[0]
-    width = image.shape[1]
+            if negative_count is None:
+                negative_count = len(crops)
 
-    for I in range(num_attempts):
+            with PROFILER.span("negative selection"):
+                free_space = _crop_free_space(scaled_boxes, scaled_size, (TARGET_WIDTH, TARGET_HEIGHT))
+                negative_crops = _sample_free_crops(free_space, (TARGET_WIDTH, TARGET_HEIGHT), negative_count, rng)
 
-        crop_left = random.randint(0, width - TARGET_WIDTH)
-        crop_top = random.randint(0, height - TARGET_HEIGHT)
-        crop_right = crop_left + TARGET_WIDTH
-        crop_bottom = crop_top + TARGET_HEIGHT
+            if len(negative_crops) < negative_count:
+                print(f"Only {len(negative_crops)} of {negative_count} negative crops exist at scale {scale} - {image_filename}")
 
-        all_boxes = []
+            PROFILER.count("negative crops", len(negative_crops))
+            PROFILER.count("negative crops missing", negative_count - len(negative_crops))
 
-        for poly in polygons:
+            windows += negative_crops.tolist()
+            annotations += [""]*len(negative_crops)
 
-            box = _box_around_polygon(poly)
-            contained_box = _box_within_box(box, [crop_left, crop_top, crop_right, crop_bottom])
+        # Crops that are not kept are still planned, so the names and random draws of the kept crops do not change
+        kept = [idx for idx in range(len(windows)) if keep is None or keep(counter + idx)]
 
-            if contained_box != None:
-                all_boxes.append(contained_box)
+        with PROFILER.span("resize"):
+            cropped_images = _resize_windows(img, scaled_size, [windows[idx] for idx in kept])
 
-        if len(all_boxes) == 0:
-            
-            cropped_image = image[crop_top:crop_bottom,crop_left:crop_right,:]
-            image_annotations = ""
+        for idx, cropped_image in zip(kept, cropped_images):
 
-            return cropped_image, image_annotations
-    
-    return None, None
+            save_filename = f"{image_filename.replace('.png', '')}_{counter + idx}"
 
-def _scale_image_and_polygons(image: np.ndarray, polygons: list, scale: float) -> tuple:
+            yield save_filename, cropped_image, annotations[idx], scale
 
-    height = image.shape[0]
-    width = image.shape[1]
+        counter += len(windows)
 
-    new_width = int(width*scale)
-    new_height = int(height*scale)
+def _process_image(task: tuple, program_arguments: dict) -> tuple:
 
-    image = cv2.resize(image, (new_width, new_height))
+    image_idx, image_filename, previous_entry, content = task
 
-    output_polygons = []
+    _enable_profiler(program_arguments)
 
-    for polygon in polygons:
+    raw_data = _open_raw_data(program_arguments["input"])
+    output_dir = program_arguments["output"]
+
+    if content is None and not raw_data.exists(image_filename) :
+        print(f"Image - {raw_data.path(image_filename)} - was not found")
+        return image_filename, "missing", 0, [], [], None, PROFILER.collect()
+
+    with PROFILER.span("annotations"):
+        annotation_index = _open_annotation_index(program_arguments["annotation_index"])
+        points, offsets = _image_polygon_points(annotation_index, image_idx)
+
+    with PROFILER.span("input hashing"):
+
+        source, content = raw_data.signature(image_filename, previous_entry["source"] if previous_entry is not None else None, content)
+
+        input_hash = _hash_inputs(
+            source["sha256"], points, offsets, SCALES, [TARGET_WIDTH, TARGET_HEIGHT], program_arguments["seed"],
+            program_arguments["negative"], program_arguments["negatives"],
+            program_arguments["image_format"], program_arguments["png_compression"], program_arguments["quality"],
+            # Only other planners are hashed, so existing outputs of the random planner stay up to date
+            *([program_arguments["planner"], program_arguments["max_appearances"]] if program_arguments["planner"] != "random" else []),
+        )
+
+    if previous_entry is not None and previous_entry["hash"] == input_hash and _outputs_exist(output_dir, previous_entry["outputs"]):
+        return image_filename, "up to date", 0, [], [], previous_entry, PROFILER.collect()
+
+    if previous_entry is not None:
+        _remove_outputs(output_dir, previous_entry["outputs"])
+
+    print(f"Processing - {raw_data.path(image_filename)}")
+
+    img = raw_data.read_image(image_filename, content)
+
+    if img is None:
+        print(f"Image - {raw_data.path(image_filename)} - could not be read")
+        return image_filename, "processed", 0, [], [], None, PROFILER.collect()
+
+    PROFILER.count("images read")
+    PROFILER.count("bytes read", source["size"])
+
+    rng = random.Random(_image_seed(program_arguments["seed"], image_filename))
+
+    with PROFILER.span("annotations"):
+        boxes = _boxes_around_polygon_points(points, offsets)
+
+    samples = _generate_samples(img, boxes, image_filename, rng, program_arguments)
+
+    if program_arguments["output_format"] == "shards":
+
+        extension = IMAGE_FORMATS[program_arguments["image_format"]]
+        encoded = []
+
+        for save_filename, cropped_image, image_annotations, scale in samples:
 
-        x_points = []
-        y_points = []
+            with PROFILER.span("encode"):
+                content = _encode_image(cropped_image, program_arguments["image_format"], program_arguments["png_compression"], program_arguments["quality"])
 
-        for x, y in zip(polygon[0], polygon[1]):
+            encoded.append((save_filename + extension, content, image_annotations, cropped_image.shape[:2], {"source": image_filename, "scale": scale}))
 
-            x_points.append( int(round(x*scale)) )
-            y_points.append( int(round(y*scale)) )
+        return image_filename, "processed", len(encoded), [], encoded, None, PROFILER.collect()
 
-        output_polygons.append([x_points, y_points])
+    writer = _DatasetWriter(output_dir, "train", program_arguments)
 
-    return image, output_polygons
+    outputs = []
+    metadata = {}
+
+    for save_filename, cropped_image, image_annotations, scale in samples:
+        outputs += writer.add_image(save_filename, cropped_image, image_annotations)
+        metadata[writer.files.image_filename(save_filename)] = {"source": image_filename, "scale": scale}
+
+    entry = {"key": image_filename, "hash": input_hash, "source": source, "outputs": outputs, "metadata": metadata}
+
+    failures = writer.close()
+    
+    return image_filename, "processed", len(outputs)//2, failures, [], entry, PROFILER.collect()
 
 def main():
 
     program_arguments = _parse_arguments()
 
-    input_dir = program_arguments["input"]
+    raw_data = _open_raw_data(program_arguments["input"])
     output_dir = program_arguments["output"]
 
-    annotations = _load_json_file(os.path.join(input_dir, "annotations.json"))
+    manifest = _Manifest(output_dir, program_arguments["resume"])
+
+    if program_arguments["seed"] is None:
+        program_arguments["seed"] = manifest.settings.get("seed", random.SystemRandom().randrange(2**32))
+        print(f"Using seed - {program_arguments['seed']}")
+
+    manifest.open({"seed": program_arguments["seed"]})
+
+    with PROFILER.span("annotation index"):
+        program_arguments["annotation_index"] = _load_annotation_index(raw_data, output_dir)
+
+    image_filenames = _open_annotation_index(program_arguments["annotation_index"])["filenames"]
+
+    in_flight = threading.BoundedSemaphore(2*program_arguments["workers"])
+
+    tasks = ((image_idx, image_filename, manifest.entries.get(image_filename), content) for image_idx, image_filename, content in _render_tasks(raw_data, image_filenames, in_flight))
+
+    process_image = partial(_process_image, program_arguments=program_arguments)
+
+    # Holds the metadata of every crop, and in shard mode also receives the encoded crops
+    dataset_writer = _DatasetWriter(output_dir, "train", program_arguments)
+
+    pool = None
+
+    if program_arguments["workers"] == 1:
+        results = map(process_image, tasks)
+
+    else:
+        pool = Pool(program_arguments["workers"])
+        results = pool.imap(process_image, tasks)
+
+    total = 0
+    skipped = 0
+    failures = []
+
+    processed = 0
+    missing = set()
 
-    all_images = list(annotations.keys())
+    for image_filename, status, count, image_failures, encoded, entry, profile in results:
 
-    counter = 0 
+        if not raw_data.random_access:
+            in_flight.release()
 
-    for image_filename in all_images:
+        if status == "missing":
+            missing.add(image_filename)
+        else:
+            processed += 1
 
-        if not os.path.exists(os.path.join(input_dir, image_filename)) :
-            print(f"Image - {os.path.join(input_dir, image_filename)} - was not found")
-            continue
+        PROFILER.merge(profile)
 
-        print(f"Processing - {os.path.join(input_dir, image_filename)}")
+        total += count
+        failures += image_failures
 
-        img = cv2.imread(os.path.join(input_dir, image_filename))
+        for filename, content, image_annotations, shape, metadata in encoded:
+            dataset_writer.add_bytes(filename, content, image_annotations, shape, metadata)
 
-        for scale in SCALES:
+        if entry is not None and len(image_failures) == 0:
 
-            for idx in range(len(annotations[image_filename]["polygons"])) :
-                
-                save_filename = f"{image_filename.replace('.png', '')}_{counter}"
-                counter += 1
+            for filename, metadata in entry.get("metadata", {}).items():
+                dataset_writer.add_metadata(filename, metadata)
 
-                cropped_image, image_annotations = _sample_from_annotation(np.copy(img), annotations, image_filename, idx, scale)
+        if status == "up to date":
+            skipped += 1
 
-                _save_image(os.path.join(output_dir, "images", "train", save_filename + ".png"), cropped_image)
-                _save_text_file(os.path.join(output_dir, "labels", "train", save_filename + ".txt"), image_annotations)
+        elif entry is not None and len(image_failures) == 0:
+            manifest.record(entry)
 
-            if program_arguments["negative"]:
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-                for idx in range(len(annotations[image_filename]["polygons"])) :
-                    
-                    save_filename = f"{image_filename.replace('.png', '')}_{counter}"
-                    counter += 1
+    failures += dataset_writer.close()
 
-                    cropped_image, image_annotations = _negative_sample_from_annotation(np.copy(img), annotations, image_filename, idx, scale)
+    removed = 0
 
-                    if image_annotations == None:
-                        print(f"Could not find negative image")
-                        continue
+    if program_arguments["output_format"] == "directory":
+        # The outputs of renders that are missing now are removed like those of renders no longer in the annotations
+        removed = manifest.finish(set(image_filenames) - missing, [os.path.join("images", "train"), os.path.join("labels", "train")])
 
-                    _save_image(os.path.join(output_dir, "images", "train", save_filename + ".png"), cropped_image)
-                    _save_text_file(os.path.join(output_dir, "labels", "train", save_filename + ".txt"), image_annotations)
+    print(f"Sampled {total} crops from {processed - skipped} images, {skipped} images were up to date and {removed} outdated files were removed")
 
+    if len(missing) > 0:
+        print(f"{len(missing)} images of the annotations were not found in - {raw_data.path_name}")
 
+    _report_profile(program_arguments)
 
+    _report_failed_writes(failures)
 
 if __name__ == "__main__" :
     main()
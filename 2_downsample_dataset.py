@@ -1,6 +1,9 @@
-import os, shutil, argparse
+import os, argparse
+import numpy as np
 
-from _utils import _create_YOLO_directory
+from _utils import _create_YOLO_directory, _add_dataset_format_arguments, _add_dataset_view_arguments, _DatasetReader, _DatasetWriter, _load_label_index, _report_failed_writes, _add_profile_arguments, _enable_profiler, _report_profile
+
+STRATA = ["source", "scale", "negative"]
 
 def _parse_arguments():
 
@@ -24,45 +27,155 @@ def _parse_arguments():
         required=True
     )
 
+    parser.add_argument(
+        "--stratify",
+        help="Sample the training images evenly within every group of the given label statistics",
+        nargs="+",
+        choices=STRATA,
+        default=[],
+    )
+
+    parser.add_argument(
+        "--balance",
+        help="Take the same number of images from every group instead of keeping the group proportions",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--negative_ratio",
+        help="Fraction of the sampled training images that are negative crops without any box (0 - 1, default: keep the ratio of the input)",
+        type=float,
+        default=None,
+    )
+
+    _add_dataset_format_arguments(parser)
+    _add_dataset_view_arguments(parser)
+    _add_profile_arguments(parser)
+
     args = vars(parser.parse_args())
+
+    _enable_profiler(args)
     
     args["input"] = os.path.abspath(args["input"])
     args["output"] = os.path.abspath(args["output"])
     args["percentage"] = int(args["percentage"])
 
+    if args["negative_ratio"] is not None and not 0 <= args["negative_ratio"] <= 1:
+        print(f"Negative ratio - {args['negative_ratio']} - should be between 0 and 1")
+        exit()
+
     if not os.path.exists(args["input"]) :
         print(f"Input directory - {args['input']} - does not exist")
         exit()
 
-    _create_YOLO_directory(args["output"])
+    _create_YOLO_directory(args["output"], args["output_format"], view=args["view"])
 
     return args
 
+def _strata(label_index: dict, keys: list) -> np.ndarray:
+
+    columns = [np.zeros(len(label_index["filenames"]), dtype=np.float64)]
+
+    if "source" in keys:
+        columns.append(label_index["sources"])
+
+    if "scale" in keys:
+        columns.append(np.nan_to_num(label_index["scales"], nan=-1))
+
+    if "negative" in keys:
+        columns.append(label_index["box_counts"] == 0)
+
+    return np.unique(np.stack(columns, axis=1).astype(np.float64), axis=0, return_inverse=True)[1].reshape(-1)
+
+def _allocate(sizes: np.ndarray, total: int, balance: bool) -> np.ndarray:
+
+    total = min(total, int(sizes.sum()))
+    counts = np.zeros(len(sizes), dtype=np.int64)
+
+    if total == 0:
+        return counts
+
+    # Small groups give everything they have and leave the rest to the larger groups
+    if balance:
+
+        remaining = total
+
+        for position, stratum in enumerate(np.argsort(sizes, kind="stable")):
+            counts[stratum] = min(sizes[stratum], remaining//(len(sizes) - position))
+            remaining -= counts[stratum]
+
+        return counts
+
+    exact = sizes*total/sizes.sum()
+    counts[:] = np.floor(exact)
+
+    for stratum in np.argsort(counts - exact, kind="stable")[:total - counts.sum()]:
+        counts[stratum] += 1
+
+    return counts
+
+def _evenly_spaced(members: np.ndarray, count: int) -> list:
+
+    return [members[int(len(members)*I/count)] for I in range(count)]
+
+def _stratified_selection(label_index: dict, members: np.ndarray, count: int, program_arguments: dict) -> list:
+
+    strata = _strata(label_index, program_arguments["stratify"])[members]
+    sizes = np.bincount(strata)
+
+    selection = []
+
+    for stratum, stratum_count in enumerate(_allocate(sizes, count, program_arguments["balance"])):
+        selection += _evenly_spaced(members[strata == stratum], stratum_count)
+
+    return selection
+
+def _select_training_images(program_arguments: dict, number_of_images: int, number_of_output_images: int) -> list:
+
+    if len(program_arguments["stratify"]) == 0 and program_arguments["negative_ratio"] is None:
+        return _evenly_spaced(np.arange(number_of_images), number_of_output_images)
+
+    label_index = _load_label_index(program_arguments["input"], "train")
+
+    if program_arguments["negative_ratio"] is None:
+        return sorted(_stratified_selection(label_index, np.arange(number_of_images), number_of_output_images, program_arguments))
+
+    negative = np.asarray(label_index["box_counts"]) == 0
+
+    negatives = min(round(number_of_output_images*program_arguments["negative_ratio"]), int(negative.sum()))
+    positives = min(number_of_output_images - negatives, int((~negative).sum()))
+
+    if negatives + positives < number_of_output_images:
+        print(f"Only {negatives + positives} of {number_of_output_images} training images can be sampled with a negative ratio of {program_arguments['negative_ratio']}")
+
+    selection = _stratified_selection(label_index, np.flatnonzero(negative), negatives, program_arguments)
+    selection += _stratified_selection(label_index, np.flatnonzero(~negative), positives, program_arguments)
+
+    return sorted(selection)
+
 def main():
 
     program_arguments = _parse_arguments()
 
-    shutil.rmtree(os.path.join(program_arguments["output"], "images", "val"))
-    shutil.rmtree(os.path.join(program_arguments["output"], "labels", "val"))
+    val_reader = _DatasetReader(program_arguments["input"], "val")
+    val_writer = _DatasetWriter(program_arguments["output"], "val", program_arguments)
 
-    shutil.copytree(os.path.join(program_arguments["input"], "images", "val"), os.path.join(program_arguments["output"], "images", "val"))
-    shutil.copytree(os.path.join(program_arguments["input"], "labels", "val"), os.path.join(program_arguments["output"], "labels", "val"))
+    for idx in range(len(val_reader)):
+        val_writer.add_from(val_reader, idx)
 
-    all_train_images = os.listdir(os.path.join(program_arguments["input"], "images", "train"))
-    all_train_images.sort()
+    train_reader = _DatasetReader(program_arguments["input"], "train")
+    train_writer = _DatasetWriter(program_arguments["output"], "train", program_arguments)
    
-    number_of_images = len(all_train_images)
+    number_of_images = len(train_reader)
     number_of_output_images = int( number_of_images*program_arguments["percentage"]/100 )
 
-    for I in range(number_of_output_images):
-
-        target_idx = int(number_of_output_images*I/number_of_output_images)
+    for target_idx in _select_training_images(program_arguments, number_of_images, number_of_output_images):
+        train_writer.add_from(train_reader, int(target_idx))
 
-        filename = all_train_images[target_idx]
-        label_name = ".".join(all_train_images[target_idx].split(".")[:-1]) + ".txt"
+    failures = val_writer.close() + train_writer.close()
 
-        shutil.copy( os.path.join(program_arguments["input"], "images", "train", filename), os.path.join(program_arguments["output"], "images", "train", filename))
-        shutil.copy( os.path.join(program_arguments["input"], "labels", "train", label_name), os.path.join(program_arguments["output"], "labels", "train", label_name))
+    _report_profile(program_arguments)
+    _report_failed_writes(failures)
 
 if __name__ == "__main__" :
     main()
\ No newline at end of file
@@ -1,6 +1,6 @@
-import os, shutil, argparse
+import os, argparse, string
 
-from _utils import _create_YOLO_directory
+from _utils import _create_YOLO_directory, _add_dataset_format_arguments, _add_dataset_view_arguments, _DatasetReader, _DatasetWriter, _report_failed_writes, _add_profile_arguments, _enable_profiler, _report_profile
 
 def _parse_arguments():
 
@@ -18,42 +18,66 @@ def _parse_arguments():
         required=True,
     )
 
+    parser.add_argument(
+        "-e", "--extra",
+        help="Directories of further datasets to merge, prefixed with c, d, ... in the given order",
+        nargs="+",
+        default=[],
+    )
+
     parser.add_argument(
         "-o", "--output",
         help="Directory where dataset should be stored",
         required=True,
     )
 
+    _add_dataset_format_arguments(parser)
+    _add_dataset_view_arguments(parser)
+    _add_profile_arguments(parser)
+
     args = vars(parser.parse_args())
+
+    _enable_profiler(args)
     
     args["a"] = os.path.abspath(args["a"])
     args["b"] = os.path.abspath(args["b"])
+    args["extra"] = [os.path.abspath(directory) for directory in args["extra"]]
     args["output"] = os.path.abspath(args["output"])
 
-    _create_YOLO_directory(args["output"])
+    if len(args["extra"]) > len(string.ascii_lowercase) - 2:
+        print(f"At most {len(string.ascii_lowercase)} datasets can be merged")
+        exit()
+
+    _create_YOLO_directory(args["output"], args["output_format"], view=args["view"])
 
     return args
 
-def _copy_directory_with_extension(source: str, target: str, suffix: str):
+def _copy_dataset_with_extension(source: str, writer: _DatasetWriter, split: str, suffix: str):
 
-    source_files = os.listdir(source)
+    reader = _DatasetReader(source, split)
 
-    for file in source_files:
-        shutil.copy(os.path.join(source, file), os.path.join(target, suffix + "_" + file))
+    for idx in range(len(reader)):
+        writer.add_from(reader, idx, suffix + "_" + reader.filenames[idx])
 
 def main():
 
     program_arguments = _parse_arguments()
 
-    _copy_directory_with_extension(os.path.join(program_arguments["a"], "images", "train"), os.path.join(program_arguments["output"], "images", "train"), "a")
-    _copy_directory_with_extension(os.path.join(program_arguments["a"], "labels", "train"), os.path.join(program_arguments["output"], "labels", "train"), "a")
-    _copy_directory_with_extension(os.path.join(program_arguments["a"], "images", "val"), os.path.join(program_arguments["output"], "images", "val"), "a")
-    _copy_directory_with_extension(os.path.join(program_arguments["a"], "labels", "val"), os.path.join(program_arguments["output"], "labels", "val"), "a")
+    failures = []
+
+    datasets = [program_arguments["a"], program_arguments["b"]] + program_arguments["extra"]
+
+    for split in ["train", "val"]:
+
+        writer = _DatasetWriter(program_arguments["output"], split, program_arguments)
+
+        for dataset, suffix in zip(datasets, string.ascii_lowercase):
+            _copy_dataset_with_extension(dataset, writer, split, suffix)
+
+        failures += writer.close()
 
-    _copy_directory_with_extension(os.path.join(program_arguments["b"], "images", "train"), os.path.join(program_arguments["output"], "images", "train"), "b")
-    _copy_directory_with_extension(os.path.join(program_arguments["b"], "labels", "train"), os.path.join(program_arguments["output"], "labels", "train"), "b")
-    _copy_directory_with_extension(os.path.join(program_arguments["b"], "images", "val"), os.path.join(program_arguments["output"], "images", "val"), "b")
-    _copy_directory_with_extension(os.path.join(program_arguments["b"], "labels", "val"), os.path.join(program_arguments["output"], "labels", "val"), "b")
+    _report_profile(program_arguments)
+    _report_failed_writes(failures)
 
 if __name__ == "__main__" :
-    main()
\ No newline at end of file
+    main()
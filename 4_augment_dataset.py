@@ -1,6 +1,27 @@
-import os, shutil, argparse, cv2
+import os, argparse, random, cv2
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
-from _utils import _create_YOLO_directory
+from _utils import (
+    _create_YOLO_directory,
+    _add_writer_arguments,
+    _add_dataset_format_arguments,
+    _DatasetReader,
+    _DatasetWriter,
+    _report_failed_writes,
+    _hash_inputs,
+    _outputs_exist,
+    _encode_image,
+    _image_seed,
+    _open_dataset_reader,
+    _add_gaussian_blur,
+    _add_gaussian_noise,
+    _Manifest,
+    _add_profile_arguments,
+    _enable_profiler,
+    _report_profile,
+    PROFILER,
+)
 
 def _parse_arguments():
 
@@ -20,26 +41,54 @@ def _parse_arguments():
 
     parser.add_argument(
         "-b", "--blurring",
-        help="The sigma of the gaussian blurring that should be added",
-        default=0,
+        help="The sigma of the gaussian blurring that should be added, several values create a sweep",
+        nargs="+",
+        default=[0],
         type=float
     )
 
     parser.add_argument(
         "-n", "--noise",
-        help="The sigma of the gaussian noise that should be added",
-        default=0,
+        help="The sigma of the gaussian noise that should be added, several values create a sweep",
+        nargs="+",
+        default=[0],
         type=float
     )
 
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes used to augment the dataset (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "-s", "--seed",
+        help="Master seed from which every image's noise is derived (default: random)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "-r", "--resume",
+        help="Keep the existing output and only regenerate images whose inputs changed or that are missing",
+        action="store_true"
+    )
+
+    _add_writer_arguments(parser)
+    _add_dataset_format_arguments(parser)
+    _add_profile_arguments(parser)
+
     args = vars(parser.parse_args())
+
+    _enable_profiler(args)
     
     args["input"] = os.path.abspath(args["input"])
     args["output"] = os.path.abspath(args["output"])
-    args["blurring"] = float(args["blurring"])
-    args["noise"] = float(args["noise"])
+    args["workers"] = max(1, args["workers"])
+    args["sweep"] = len(args["blurring"]) > 1 or len(args["noise"]) > 1
 
-    if args["blurring"] == 0 and args["noise"] == 0:
+    if not args["sweep"] and args["blurring"][0] == 0 and args["noise"][0] == 0:
         print("No gaussian or noise value was specified")
         exit()
 
@@ -47,64 +96,214 @@ def _parse_arguments():
         print(f"Input directory - {args['input']} - does not exist")
         exit()
 
-    _create_YOLO_directory(args["output"])
+    if args["resume"] and args["output_format"] == "shards":
+        print("Resuming is only supported for the directory output format")
+        exit()
+
+    args["configurations"] = _configurations(args)
+
+    for configuration in args["configurations"]:
+        _create_YOLO_directory(configuration["output"], args["output_format"], clean=not args["resume"])
 
     return args
 
-def _add_gaussian_blur(img: np.ndarray, sigma: float) -> np.ndarray:
-    
-    kernel_size = max(3, int(6*sigma + 1))
+def _content_hashes(signature: dict) -> dict:
 
-    if kernel_size % 2 == 0:
-        kernel_size += 1
+    return {name: value["sha256"] for name, value in signature.items()}
 
-    return cv2.GaussianBlur(img, (kernel_size, kernel_size), sigmaX=sigma, sigmaY=sigma)
+def _configurations(program_arguments: dict) -> list:
 
-def _add_gaussian_noise(img: np.ndarray, sigma: float) -> np.ndarray:   
-    
-    height = img.shape[0]
-    width = img.shape[1]
+    if not program_arguments["sweep"]:
+        return [{"blurring": program_arguments["blurring"][0], "noise": program_arguments["noise"][0], "output": program_arguments["output"]}]
+
+    return [
+        {"blurring": blurring, "noise": noise, "output": os.path.join(program_arguments["output"], f"blurring_{blurring:g}_noise_{noise:g}")}
+        for blurring in program_arguments["blurring"] for noise in program_arguments["noise"]
+    ]
+
+def _augment_image(task: tuple, program_arguments: dict) -> tuple:
+
+    idx, image_file, previous_entries = task
+
+    _enable_profiler(program_arguments)
+
+    reader = _open_dataset_reader(program_arguments["input"], "train")
+
+    with PROFILER.span("input hashing"):
+        cached = next((entry["source"] for entry in previous_entries if entry is not None), None)
+        signature = reader.signature(idx, cached)
+
+    img = None
+    blurred = {}
+    results = []
+
+    # The image is decoded and blurred once, and every configuration adds its own noise to that buffer
+    for configuration, previous_entry in zip(program_arguments["configurations"], previous_entries):
+
+        input_hash = _hash_inputs(
+            "augment", _content_hashes(signature), configuration["blurring"], configuration["noise"], program_arguments["seed"],
+            program_arguments["image_format"], program_arguments["png_compression"], program_arguments["quality"],
+        )
+
+        entry = {"key": f"train/{image_file}", "hash": input_hash, "source": signature}
+
+        if previous_entry is not None and previous_entry["hash"] == input_hash and _outputs_exist(configuration["output"], previous_entry["outputs"]):
+            PROFILER.count("images up to date")
+            results.append((entry, None))
+            continue
+
+        if img is None:
+            print(f"Processing {image_file}")
+            img = reader.read_image(idx, cv2.IMREAD_UNCHANGED)
+
+        if configuration["blurring"] not in blurred:
+            with PROFILER.span("blur"):
+                blurred[configuration["blurring"]] = img if configuration["blurring"] == 0 else _add_gaussian_blur(img, configuration["blurring"])
+
+        augmented = blurred[configuration["blurring"]]
+
+        if configuration["noise"] != 0:
+            with PROFILER.span("noise"):
+                augmented = _add_gaussian_noise(augmented, configuration["noise"], np.random.default_rng(_image_seed(program_arguments["seed"], image_file)))
+
+        # Worker processes encode the image themselves so only the compressed bytes are sent back
+        if program_arguments["workers"] > 1:
+            with PROFILER.span("encode"):
+                augmented = _encode_image(augmented, program_arguments["image_format"], program_arguments["png_compression"], program_arguments["quality"])
+
+        PROFILER.count("images augmented")
+        results.append((entry, augmented))
+
+    annotations = reader.read_annotations(idx) if img is not None else None
+
+    return idx, results, annotations, PROFILER.collect()
 
-    img = img.astype(np.float32)
-    img = img + np.random.normal(0, sigma, (height, width, 3))
+def _copy_val_split(program_arguments: dict, manifest: _Manifest, writer: _DatasetWriter, keys: set) -> None:
 
-    img = np.clip(img, 0, 255)
-    img = np.round(img)
-    img = img.astype(np.uint8)
+    reader = _DatasetReader(program_arguments["input"], "val")
 
-    return img
+    for idx, image_file in enumerate(reader.filenames):
+
+        key = f"val/{image_file}"
+        previous_entry = manifest.entries.get(key, {})
+
+        signature = reader.signature(idx, previous_entry.get("source"))
+        input_hash = _hash_inputs("copy", _content_hashes(signature))
+
+        keys.add(key)
+
+        if manifest.is_current(key, input_hash):
+            writer.add_metadata(image_file, reader.metadata(idx))
+            continue
+
+        manifest.remove(key)
+
+        outputs = writer.add_from(reader, idx)
+        manifest.record({"key": key, "hash": input_hash, "source": signature, "outputs": outputs})
 
 def main():
 
     program_arguments = _parse_arguments()
 
-    shutil.rmtree(os.path.join(program_arguments["output"], "images", "val"))
-    shutil.rmtree(os.path.join(program_arguments["output"], "labels", "val"))
-    shutil.rmtree(os.path.join(program_arguments["output"], "labels", "train"))
+    outputs = []
+
+    for configuration in program_arguments["configurations"]:
+
+        manifest = _Manifest(configuration["output"], program_arguments["resume"])
+
+        if program_arguments["seed"] is None:
+            program_arguments["seed"] = manifest.settings.get("seed", random.SystemRandom().randrange(2**32))
+            print(f"Using seed - {program_arguments['seed']}")
+
+        manifest.open({"seed": program_arguments["seed"]})
+
+        # A sweep links the unchanged validation split and labels into every configuration instead of copying them
+        writer_arguments = dict(program_arguments, view="hardlink" if program_arguments["sweep"] else "copy")
+
+        outputs.append({
+            "configuration": configuration,
+            "manifest": manifest,
+            "train_writer": _DatasetWriter(configuration["output"], "train", writer_arguments),
+            "val_writer": _DatasetWriter(configuration["output"], "val", writer_arguments),
+            "keys": set(),
+        })
+
+    for output in outputs:
+        _copy_val_split(program_arguments, output["manifest"], output["val_writer"], output["keys"])
+
+    train_reader = _DatasetReader(program_arguments["input"], "train")
+
+    share_labels = program_arguments["sweep"] and train_reader.shards is None and program_arguments["output_format"] == "directory"
+
+    tasks = (
+        (idx, image_file, [output["manifest"].entries.get(f"train/{image_file}") for output in outputs])
+        for idx, image_file in enumerate(train_reader.filenames)
+    )
+
+    augment_image = partial(_augment_image, program_arguments=program_arguments)
+
+    pool = None
+
+    if program_arguments["workers"] == 1:
+        results = map(augment_image, tasks)
+
+    else:
+        pool = Pool(program_arguments["workers"], initializer=cv2.setNumThreads, initargs=(1,))
+        results = pool.imap(augment_image, tasks)
+
+    for idx, image_results, annotations, profile in results:
+
+        PROFILER.merge(profile)
+
+        for output, (entry, img) in zip(outputs, image_results):
+
+            output["keys"].add(entry["key"])
+
+            train_writer = output["train_writer"]
+            image_file = train_writer.files.image_filename(entry["key"].split("/", 1)[1])
+
+            if img is None:
+                train_writer.add_metadata(image_file, train_reader.metadata(idx))
+                continue
+
+            output["manifest"].remove(entry["key"])
+
+            image_annotations = None if share_labels else annotations
+
+            if program_arguments["workers"] > 1:
+                entry["outputs"] = train_writer.add_bytes(image_file, img, image_annotations, metadata=train_reader.metadata(idx))
+            else:
+                entry["outputs"] = train_writer.add_image(image_file, img, image_annotations, metadata=train_reader.metadata(idx))
+
+            if share_labels:
+                entry["outputs"] += train_writer.add_label_from(train_reader, idx, image_file)
+
+            output["manifest"].record(entry)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    failures = []
 
-    shutil.copytree(os.path.join(program_arguments["input"], "images", "val"), os.path.join(program_arguments["output"], "images", "val"))
-    shutil.copytree(os.path.join(program_arguments["input"], "labels", "val"), os.path.join(program_arguments["output"], "labels", "val"))
-    shutil.copytree(os.path.join(program_arguments["input"], "labels", "train"), os.path.join(program_arguments["output"], "labels", "train"))
+    for output in outputs:
 
-    train_path = os.path.join(program_arguments["input"], "images", "train")
-    output_train_path = os.path.join(program_arguments["output"], "images", "train")
+        output_failures = output["val_writer"].close() + output["train_writer"].close()
 
-    all_train_images = os.listdir(train_path)
-    all_train_images.sort()
-   
-    for image_file in all_train_images:
+        if program_arguments["output_format"] == "directory":
 
-        print(f"Processing {image_file}")
+            manifest = output["manifest"]
 
-        img = cv2.imread(os.path.join(train_path, image_file), cv2.IMREAD_UNCHANGED)
+            for filename, _ in output_failures:
+                for key in [key for key, entry in manifest.entries.items() if os.path.relpath(filename, output["configuration"]["output"]) in entry["outputs"]]:
+                    manifest.remove(key)
 
-        if program_arguments["blurring"] != 0:
-            img = _add_gaussian_blur(img, program_arguments["blurring"])
+            manifest.finish(output["keys"], [os.path.join(folder, split) for folder in ["images", "labels"] for split in ["train", "val"]])
 
-        if program_arguments["noise"] != 0:
-            img = _add_gaussian_noise(img, program_arguments["noise"])
+        failures += output_failures
 
-        cv2.imwrite(os.path.join(output_train_path, image_file), img)
+    _report_profile(program_arguments)
+    _report_failed_writes(failures)
 
 if __name__ == "__main__" :
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,20 @@
-import argparse, os
+import argparse, os, sys, json, math, time, random, socket, multiprocessing, cv2
+import numpy as np
+import torch
 from ultralytics import YOLO
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+import ultralytics.data.build as ultralytics_build
 from threading import Thread
 
+from _utils import _is_shard_dataset, _ShardReader, _DatasetReader, _add_gaussian_blur, _add_gaussian_noise, _add_profile_arguments, _enable_profiler, _report_profile, PROFILER
+
 IMAGE_SIZE = 640
+CACHE_MODES = ["ram", "disk"]
+AUTOTUNE_WARMUP_BATCHES = 3
+AUTOTUNE_BATCH_SIZES = [4, 8, 16, 32]
+AUTOTUNE_WORKERS = [0, 2, 4, 8]
+AUTOTUNE_CACHE_SAMPLES = 20
 
 def _parse_arguments():
 
@@ -53,8 +65,102 @@ def _parse_arguments():
         default=40,
     )
 
+    parser.add_argument(
+        "--batch",
+        help="Batch size (default: 16)",
+        type=int,
+        default=16,
+    )
+
+    parser.add_argument(
+        "--device",
+        help="Device to train on, e.g. cpu, 0 or 0,1 (default: first available GPU, otherwise cpu)",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="Number of dataloader worker processes (default: 8)",
+        type=int,
+        default=8,
+    )
+
+    parser.add_argument(
+        "--threads",
+        help="Number of CPU threads PyTorch computes with (default: PyTorch default)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cache",
+        help="Cache the decoded training images in RAM or on disk (default: no cache)",
+        choices=CACHE_MODES,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--autotune",
+        help="Measure the training speed with several batch sizes, dataloader workers, thread counts and cache modes before training and train with the fastest",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--autotune_batches",
+        help="Number of batches every setting is timed over (default: 20)",
+        type=int,
+        default=20,
+    )
+
+    parser.add_argument(
+        "--autotune_memory",
+        help="Largest memory use in GB a tuned setting may reach (default: no limit)",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--retune",
+        help="Tune again even if settings for this host and dataset were saved before",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "-b", "--blurring",
+        help="The sigma of the gaussian blurring added to training images while training",
+        default=0,
+        type=float
+    )
+
+    parser.add_argument(
+        "-n", "--noise",
+        help="The sigma of the gaussian noise added to training images while training",
+        default=0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--random_sigma",
+        help="Draw the blurring and noise sigma of every training image uniformly between 0 and the given sigma",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "-s", "--seed",
+        help="Seed of the blurring and noise augmentation (default: random)",
+        type=int,
+        default=None,
+    )
+
+    _add_profile_arguments(parser)
+
     args = vars(parser.parse_args())
 
+    _enable_profiler(args)
+
+    if args["seed"] is None:
+        args["seed"] = random.SystemRandom().randrange(2**32)
+
     print(args["dataset"])
 
     args["dataset"] = os.path.join(args["dataset"], "data.yaml")
@@ -66,6 +172,11 @@ def _parse_arguments():
         print(f"Dataset - {args['dataset']} - is not valid")
         exit()
 
+    # Ultralytics caches to disk by reading every image file again, which shards do not have
+    if args["cache"] == "disk" and _is_shard_dataset(os.path.dirname(args["dataset"])):
+        print("Shard datasets can not be cached on disk, use --cache ram instead")
+        exit()
+
     if not os.path.exists(args["output"]) :
         os.makedirs(args["output"])
 
@@ -93,29 +204,464 @@ def _freeze_backbone(trainer):
             print(f"Freezing layer: {name}")
             param.requires_grad = False
 
-def _train_model(program_arguments):
+class _BlurNoise:
+
+    def __init__(self, blurring: float, noise: float, random_sigma: bool, seed: int):
+
+        self.blurring = blurring
+        self.noise = noise
+        self.random_sigma = random_sigma
+        self.seed = seed
+
+        self.rng = None
+
+    def __call__(self, labels: dict) -> dict:
+
+        # Every dataloader worker starts its own stream, worker.seed changes whenever the workers are restarted
+        if self.rng is None:
+            worker = torch.utils.data.get_worker_info()
+            self.rng = np.random.default_rng([self.seed] if worker is None else [self.seed, worker.seed])
+
+        blurring = self.blurring
+        noise = self.noise
+
+        if self.random_sigma:
+            blurring = self.rng.uniform(0, blurring)
+            noise = self.rng.uniform(0, noise)
+
+        if blurring != 0:
+            with PROFILER.span("blur"):
+                labels["img"] = _add_gaussian_blur(labels["img"], blurring)
+
+        if noise != 0:
+            with PROFILER.span("noise"):
+                labels["img"] = _add_gaussian_noise(labels["img"], noise, self.rng)
+
+        return labels
+
+def _add_blur_noise(trainer, program_arguments):
+
+    dataset = trainer.train_loader.dataset
+    blur_noise = _BlurNoise(program_arguments["blurring"], program_arguments["noise"], program_arguments["random_sigma"], program_arguments["seed"])
+
+    print(f"Adding gaussian blurring (sigma {program_arguments['blurring']}) and noise (sigma {program_arguments['noise']}) with seed {program_arguments['seed']}")
+
+    build_transforms = dataset.build_transforms
+
+    # Runs just before Format turns the image into a tensor, also after close_mosaic rebuilds the transforms
+    def build_transforms_with_blur_noise(hyp=None):
+
+        transforms = build_transforms(hyp)
+        transforms.insert(-1, blur_noise)
+
+        return transforms
+
+    dataset.build_transforms = build_transforms_with_blur_noise
+    dataset.transforms.insert(-1, blur_noise)
+
+    # The dataloader workers were started with the old transforms
+    trainer.train_loader.reset()
+
+def _add_profile_callbacks(model):
+
+    started = {}
+
+    def start(name):
+        started[name] = time.perf_counter()
+
+    def stop(name):
+        if name in started:
+            PROFILER.add_time(name, time.perf_counter() - started.pop(name))
+
+    def batch_start(trainer):
+        stop("data loading")
+        start("batch")
+
+    # The time between two batches is spent waiting for the dataloader
+    def batch_end(trainer):
+        stop("batch")
+        PROFILER.count("images trained", trainer.batch_size)
+        start("data loading")
+
+    def epoch_end(trainer):
+        started.pop("data loading", None)
+        stop("train epoch")
+        start("validation")
+
+    model.add_callback("on_pretrain_routine_start", lambda trainer: start("setup"))
+    model.add_callback("on_train_start", lambda trainer: stop("setup"))
+    model.add_callback("on_train_epoch_start", lambda trainer: start("train epoch"))
+    model.add_callback("on_train_batch_start", batch_start)
+    model.add_callback("on_train_batch_end", batch_end)
+    model.add_callback("on_train_epoch_end", epoch_end)
+    model.add_callback("on_fit_epoch_end", lambda trainer: stop("validation"))
+
+class _ShardDataset(YOLODataset):
+
+    def get_img_files(self, img_path):
+
+        self.shard_reader = _ShardReader(img_path)
+
+        im_files = [os.path.join(img_path, filename) for filename in self.shard_reader.filenames]
+
+        return im_files[:round(len(im_files)*self.fraction)]
+
+    def get_labels(self):
+
+        labels = []
+
+        for idx, im_file in enumerate(self.im_files):
+
+            rows = self.shard_reader.labels(idx).astype(np.float32)
+
+            labels.append({
+                "im_file": im_file,
+                "shape": self.shard_reader.shape(idx),
+                "cls": rows[:, 0:1],
+                "bboxes": rows[:, 1:5],
+                "segments": [],
+                "keypoints": None,
+                "normalized": True,
+                "bbox_format": "xywh",
+            })
+
+        return labels
+
+    def load_image(self, i, rect_mode=True):
+
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+
+        im = cv2.imdecode(np.frombuffer(self.shard_reader.read(i), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+        if im is None:
+            raise FileNotFoundError(f"Image Not Found {self.im_files[i]}")
+
+        h0, w0 = im.shape[:2]
+
+        if rect_mode:
+            r = self.imgsz/max(h0, w0)
+            if r != 1:
+                w, h = (min(math.ceil(w0*r), self.imgsz), min(math.ceil(h0*r), self.imgsz))
+                im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        elif not (h0 == w0 == self.imgsz):
+            im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
 
-    model = YOLO(program_arguments["model"])
+        if self.augment:
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+
+            if len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+
+        return im, (h0, w0), im.shape[:2]
+
+class _ShardDetectionTrainer(DetectionTrainer):
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+
+        yolo_dataset = ultralytics_build.YOLODataset
+        ultralytics_build.YOLODataset = _ShardDataset
+
+        try:
+            return super().build_dataset(img_path, mode, batch)
+        finally:
+            ultralytics_build.YOLODataset = yolo_dataset
+
+def _prepare_model(program_arguments, callbacks=()):
+
+    with PROFILER.span("model loading"):
+        model = YOLO(program_arguments["model"])
+
+    for event, callback in callbacks:
+        model.add_callback(event, callback)
+
+    if PROFILER.enabled:
+        _add_profile_callbacks(model)
 
     if program_arguments["freeze"] :
         model.add_callback("on_train_start", _freeze_backbone)
 
+    if program_arguments["blurring"] != 0 or program_arguments["noise"] != 0:
+        model.add_callback("on_pretrain_routine_end", lambda trainer: _add_blur_noise(trainer, program_arguments))
+
+    # Ultralytics loads the data in the training process when training on CPU, a tuned number of workers is used instead
+    if program_arguments["autotune"]:
+        model.add_callback("on_pretrain_routine_start", lambda trainer: setattr(trainer.args, "workers", program_arguments["workers"]))
+
+    trainer = None
+
+    if _is_shard_dataset(os.path.dirname(program_arguments["dataset"])):
+        trainer = _ShardDetectionTrainer
+
+    return model, trainer
+
+def _training_settings(program_arguments):
+
+    return dict(
+        data=program_arguments["dataset"],
+        epochs=program_arguments["epochs"],
+        imgsz=IMAGE_SIZE,
+        patience=program_arguments["patience"],
+        batch=program_arguments["batch"],
+        device=program_arguments["device"],
+        workers=program_arguments["workers"],
+        cache=program_arguments["cache"] or False,
+    )
+
+class _CalibrationFinished(Exception):
+    pass
+
+def _calibrate(candidate, program_arguments, connection):
+
+    arguments = dict(program_arguments, **candidate)
+    calibration_directory = os.path.join(program_arguments["output"], "autotune")
+
+    # The Ultralytics output of every setting goes to a log instead of the console
+    with open(os.path.join(calibration_directory, "calibration.log"), "a") as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+
+    if arguments["threads"] is not None:
+        torch.set_num_threads(arguments["threads"])
+
+    batch_ends = []
+
+    # Ultralytics builds the RAM cache with the dataloaders before the first batch, so it is never part of the timed batches
+    def batch_end(trainer):
+
+        batch_ends.append(time.perf_counter())
+
+        if len(batch_ends) > AUTOTUNE_WARMUP_BATCHES + program_arguments["autotune_batches"]:
+            raise _CalibrationFinished()
+
+    # Only as many training images as the timed batches need are loaded or cached
+    images = (AUTOTUNE_WARMUP_BATCHES + program_arguments["autotune_batches"] + 1)*arguments["batch"]
+    fraction = min(1.0, images/max(1, len(_DatasetReader(os.path.dirname(arguments["dataset"]), "train"))))
+
+    model, trainer = _prepare_model(arguments, [("on_train_batch_end", batch_end)])
+
+    try:
+        model.train(trainer=trainer, **_training_settings(arguments), fraction=fraction, val=False, plots=False, save=False, project=calibration_directory, name="run", exist_ok=True)
+
+    except _CalibrationFinished:
+        pass
+
+    except Exception as error:
+        connection.send({"error": f"{type(error).__name__}: {error}"})
+        return
+
+    timed = batch_ends[AUTOTUNE_WARMUP_BATCHES:]
+
+    if len(timed) < 2:
+        connection.send({"error": "the dataset is too small to time the training"})
+        return
+
+    connection.send({"images_per_second": (len(timed) - 1)*arguments["batch"]/(timed[-1] - timed[0])})
+
+def _memory_in_use(pid):
+
+    import psutil
+
+    # Pages the dataloader workers share with the training process are counted for every worker, so this is an upper bound
+    try:
+        processes = [psutil.Process(pid)]
+        processes += processes[0].children(recursive=True)
+    except psutil.Error:
+        return 0
+
+    memory = 0
+
+    for process in processes:
+        try:
+            memory += process.memory_info().rss
+        except psutil.Error:
+            continue
+
+    return memory
+
+def _measure(candidate, program_arguments):
+
+    # Every setting runs in a fresh process, so thread pools, caches and the peak memory do not carry over
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+
+    process = context.Process(target=_calibrate, args=(candidate, program_arguments, sender))
+    process.start()
+
+    peak_memory = 0
+
+    while process.is_alive():
+        peak_memory = max(peak_memory, _memory_in_use(process.pid))
+        process.join(0.2)
+
+    result = receiver.recv() if receiver.poll() else {"error": f"calibration exited with code {process.exitcode}"}
+    result["peak_memory_gb"] = peak_memory/2**30
+
+    return result
+
+def _ram_cache_size(program_arguments):
+
+    reader = _DatasetReader(os.path.dirname(program_arguments["dataset"]), "train")
+
+    if len(reader) == 0:
+        return 0
+
+    # Ultralytics caches every image decoded and resized to the image size, the shape of a few evenly spread images is extrapolated
+    indices = np.linspace(0, len(reader) - 1, min(len(reader), AUTOTUNE_CACHE_SAMPLES)).round().astype(int)
+    sizes = []
+
+    for idx in indices.tolist():
+
+        shape = reader.shape(idx)
+
+        if shape is None:
+            img = reader.read_image(idx)
+            shape = None if img is None else img.shape[:2]
+
+        if shape is not None:
+            r = IMAGE_SIZE/max(shape)
+            sizes.append(min(math.ceil(shape[0]*r), IMAGE_SIZE)*min(math.ceil(shape[1]*r), IMAGE_SIZE)*3)
+
+    return len(reader)*np.mean(sizes) if len(sizes) > 0 else 0
+
+def _available_cpus():
+
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+def _autotune_key(program_arguments):
+
+    return json.dumps({
+        "host": socket.gethostname(),
+        "cpus": _available_cpus(),
+        "device": program_arguments["device"],
+        "model": os.path.basename(program_arguments["model"]),
+        "freeze": program_arguments["freeze"],
+        "blurring": program_arguments["blurring"],
+        "noise": program_arguments["noise"],
+    }, sort_keys=True)
+
+def _autotune(program_arguments):
+
+    settings_filename = os.path.join(os.path.dirname(program_arguments["dataset"]), ".autotune.json")
+    key = _autotune_key(program_arguments)
+
+    saved = {}
+
+    if os.path.exists(settings_filename):
+        with open(settings_filename, "r") as f:
+            saved = json.load(f)
+
+    if key in saved and not program_arguments["retune"]:
+        print(f"Using the training settings tuned before for this host and dataset - {saved[key]}")
+        return saved[key]
+
+    cpus = _available_cpus()
+
+    # Every setting is tuned in turn while the others keep their best value so far
+    axes = [
+        ("batch", AUTOTUNE_BATCH_SIZES),
+        ("threads", sorted({max(1, cpus//4), max(1, cpus//2), cpus})),
+        ("workers", sorted({min(workers, cpus) for workers in AUTOTUNE_WORKERS})),
+        ("cache", [None, "ram"]),
+    ]
+
+    best = {"batch": program_arguments["batch"], "threads": program_arguments["threads"] or torch.get_num_threads(), "workers": program_arguments["workers"], "cache": program_arguments["cache"]}
+    best_result = None
+    measured = {}
+
+    # The calibration only caches the images it trains on, so the cache of the full training split is estimated
+    cache_memory_gb = _ram_cache_size(program_arguments)/2**30
+
+    os.makedirs(os.path.join(program_arguments["output"], "autotune"), exist_ok=True)
+
+    print(f"Tuning the training speed on {cpus} CPUs, see {os.path.join(program_arguments['output'], 'autotune', 'calibration.log')}")
+
+    for name, values in axes:
+
+        for value in values:
+
+            candidate = dict(best, **{name: value})
+            candidate_key = json.dumps(candidate, sort_keys=True)
+
+            if candidate_key not in measured:
+
+                measured[candidate_key] = _measure(candidate, program_arguments)
+                result = measured[candidate_key]
+
+                if candidate["cache"] == "ram" and "error" not in result:
+                    result["peak_memory_gb"] += cache_memory_gb
+
+                description = ", ".join(f"{setting} {candidate[setting]}" for setting in ["batch", "threads", "workers", "cache"])
+
+                if "error" in result:
+                    print(f"  {description} - failed ({result['error']})")
+                else:
+                    print(f"  {description} - {result['images_per_second']:.2f} images/s, {result['peak_memory_gb']:.1f} GB")
+
+            result = measured[candidate_key]
+
+            if "error" in result:
+                continue
+
+            if program_arguments["autotune_memory"] is not None and result["peak_memory_gb"] > program_arguments["autotune_memory"]:
+                continue
+
+            if best_result is None or result["images_per_second"] > best_result["images_per_second"]:
+                best, best_result = candidate, result
+
+    if best_result is None:
+        print("No setting could be timed, training with the given settings")
+        return {}
+
+    tuned = dict(best, images_per_second=best_result["images_per_second"], peak_memory_gb=best_result["peak_memory_gb"])
+    saved[key] = tuned
+
+    try:
+        with open(settings_filename, "w") as f:
+            json.dump(saved, f, indent=2)
+
+    except OSError:
+        print(f"Could not save the tuned settings to - {settings_filename}")
+
+    print(f"Training with {', '.join(f'{setting} {best[setting]}' for setting in ['batch', 'threads', 'workers', 'cache'])}")
+
+    return tuned
+
+def _train_model(program_arguments, callbacks=()):
+
+    if program_arguments["threads"] is not None:
+        torch.set_num_threads(program_arguments["threads"])
+
+    model, trainer = _prepare_model(program_arguments, callbacks)
+
     results = model.train(
-        data=program_arguments["dataset"], 
-        epochs=program_arguments["epochs"], 
-        imgsz=IMAGE_SIZE, 
-        save=True, 
+        trainer=trainer,
+        save=True,
         save_period=program_arguments["save_period"],
         project=program_arguments["output"],
-        patience=program_arguments["patience"]
+        **_training_settings(program_arguments),
     )
 
     print(f"The final mAP score: {results.results_dict['metrics/mAP50(B)']}")
 
+    with open(os.path.join(program_arguments["output"], "results.json"), "w") as f:
+        json.dump({"arguments": program_arguments, "metrics": {name: float(value) for name, value in results.results_dict.items()}}, f, indent=2)
+
+    _report_profile(program_arguments)
+
+    return results.results_dict
+
 def main():
 
     program_arguments = _parse_arguments()
 
+    if program_arguments["autotune"]:
+        tuned = _autotune(program_arguments)
+        program_arguments.update({setting: tuned[setting] for setting in ["batch", "threads", "workers", "cache"] if setting in tuned})
+
     t = Thread(target=_train_model, args=(program_arguments,))
     t.start()
     t.join()
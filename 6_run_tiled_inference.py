@@ -0,0 +1,356 @@
+import argparse, os, json, queue, importlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import numpy as np
+import cv2
+from ultralytics import YOLO
+
+from _utils import IMAGE_EXTENSIONS, _non_maximum_suppression, _add_profile_arguments, _enable_profiler, _report_profile, PROFILER
+
+# The tiles are cut exactly like the training crops
+create_synthetic_dataset = importlib.import_module("1_create_synthetic_dataset")
+
+PADDING_VALUE = 114
+
+def _parse_arguments() -> dict:
+
+    parser = argparse.ArgumentParser("Run Tiled Inference")
+
+    parser.add_argument(
+        "-m", "--model",
+        help="Trained weights file (.pt) to run",
+        required=True,
+    )
+
+    parser.add_argument(
+        "-i", "--input",
+        help="Image or directory of images to detect crocodiles in",
+        required=True,
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="JSON lines file where the detections of every image are stored (default: detections.jsonl)",
+        default="detections.jsonl"
+    )
+
+    parser.add_argument(
+        "--scales",
+        help=f"Scales at which the images are tiled (default: {' '.join(str(scale) for scale in create_synthetic_dataset.SCALES)})",
+        nargs="+",
+        type=float,
+        default=create_synthetic_dataset.SCALES,
+    )
+
+    parser.add_argument(
+        "--overlap",
+        help="Fraction by which neighbouring tiles overlap (0 - 1, default: 0.2)",
+        type=float,
+        default=0.2,
+    )
+
+    parser.add_argument(
+        "--conf",
+        help="Minimum confidence of a detection (default: 0.25)",
+        type=float,
+        default=0.25,
+    )
+
+    parser.add_argument(
+        "--iou",
+        help="IoU above which overlapping detections of different tiles and scales are merged (default: 0.5)",
+        type=float,
+        default=0.5,
+    )
+
+    parser.add_argument(
+        "--batch",
+        help="Number of tiles passed through the model at once (default: 16)",
+        type=int,
+        default=16,
+    )
+
+    parser.add_argument(
+        "--device",
+        help="Device to run on, e.g. cpu or 0 (default: first available GPU, otherwise cpu)",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of threads that decode and tile images while the model runs (default: 2)",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "-r", "--resume",
+        help="Keep the detections already in the output and only process the remaining images",
+        action="store_true"
+    )
+
+    _add_profile_arguments(parser)
+
+    args = vars(parser.parse_args())
+
+    _enable_profiler(args)
+
+    args["input"] = os.path.abspath(args["input"])
+    args["output"] = os.path.abspath(args["output"])
+    args["workers"] = max(1, args["workers"])
+    args["batch"] = max(1, args["batch"])
+
+    if not os.path.exists(args["model"]):
+        print(f"Model - {args['model']} - does not exist")
+        exit()
+
+    if not os.path.exists(args["input"]):
+        print(f"Input - {args['input']} - does not exist")
+        exit()
+
+    if not 0 <= args["overlap"] < 1:
+        print(f"Overlap - {args['overlap']} - should be at least 0 and below 1")
+        exit()
+
+    os.makedirs(os.path.dirname(args["output"]), exist_ok=True)
+
+    return args
+
+def _list_images(input_path: str) -> list:
+
+    if os.path.isfile(input_path):
+        return [input_path]
+
+    return [os.path.join(input_path, filename) for filename in sorted(os.listdir(input_path)) if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS]
+
+def _finished_images(filename: str) -> set:
+
+    finished = set()
+
+    if not os.path.exists(filename):
+        return finished
+
+    with open(filename, "r") as f:
+
+        for line in f:
+
+            # A line cut off by an interrupted run is processed again
+            try:
+                finished.add(json.loads(line)["image"])
+            except (json.JSONDecodeError, KeyError):
+                continue
+
+    return finished
+
+def _tile_positions(size: int, tile_size: int, overlap: float) -> list:
+
+    if size <= tile_size:
+        return [0]
+
+    stride = max(1, int(tile_size*(1 - overlap)))
+
+    # The last tile is moved back to end on the image border
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+def _tile_image(image_path: str, program_arguments: dict) -> tuple:
+
+    with PROFILER.span("decode"):
+        img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+
+    if img is None:
+        return image_path, None, [], []
+
+    tile_width = create_synthetic_dataset.TARGET_WIDTH
+    tile_height = create_synthetic_dataset.TARGET_HEIGHT
+
+    tiles = []
+    windows = []
+
+    with PROFILER.span("tile"):
+
+        for scale in program_arguments["scales"]:
+
+            scaled_size = create_synthetic_dataset._scaled_size(img, scale)
+            scaled_image = img if scale == 1 else cv2.resize(img, scaled_size, interpolation=cv2.INTER_LINEAR)
+
+            for top in _tile_positions(scaled_size[1], tile_height, program_arguments["overlap"]):
+                for left in _tile_positions(scaled_size[0], tile_width, program_arguments["overlap"]):
+
+                    tile = scaled_image[top:top + tile_height, left:left + tile_width]
+
+                    # Frames smaller than a tile are padded like the letterboxing of the model
+                    if tile.shape[:2] != (tile_height, tile_width):
+                        tile = cv2.copyMakeBorder(tile, 0, tile_height - tile.shape[0], 0, tile_width - tile.shape[1], cv2.BORDER_CONSTANT, value=(PADDING_VALUE,)*3)
+
+                    tiles.append(tile)
+                    windows.append((left, top, scale))
+
+    PROFILER.count("images tiled")
+    PROFILER.count("tiles", len(tiles))
+
+    return image_path, img.shape[:2], tiles, windows
+
+def _produce_tiles(image_paths: list, tile_queue: queue.Queue, program_arguments: dict) -> None:
+
+    try:
+
+        with ThreadPoolExecutor(max_workers=program_arguments["workers"]) as executor:
+
+            # Only a few images are decoded ahead so memory stays bounded on large backlogs
+            pending = deque()
+
+            for image_path in image_paths:
+
+                pending.append(executor.submit(_tile_image, image_path, program_arguments))
+
+                if len(pending) > program_arguments["workers"]:
+                    tile_queue.put(pending.popleft().result())
+
+            while len(pending) > 0:
+                tile_queue.put(pending.popleft().result())
+
+    except Exception as exception:
+        tile_queue.put(exception)
+
+    finally:
+        tile_queue.put(None)
+
+def _detect(model, tiles: list, windows: list, image_shapes: list, program_arguments: dict) -> list:
+
+    with PROFILER.span("inference"):
+        results = model.predict(
+            tiles,
+            imgsz=[create_synthetic_dataset.TARGET_HEIGHT, create_synthetic_dataset.TARGET_WIDTH],
+            conf=program_arguments["conf"],
+            iou=program_arguments["iou"],
+            device=program_arguments["device"],
+            verbose=False,
+        )
+
+    PROFILER.count("tiles detected", len(tiles))
+
+    detections = []
+
+    for result, (left, top, scale), (height, width) in zip(results, windows, image_shapes):
+
+        boxes = result.boxes.xyxy.cpu().numpy().astype(np.float64)
+
+        # Tile coordinates are moved into the scaled frame and scaled back to the original image
+        boxes = (boxes + [left, top, left, top])/scale
+        boxes = np.clip(boxes, 0, [width, height, width, height])
+
+        detections.append((boxes, result.boxes.conf.cpu().numpy(), result.boxes.cls.cpu().numpy().astype(np.int64)))
+
+    return detections
+
+def _merge_detections(detections: list, iou_threshold: float) -> list:
+
+    if len(detections) == 0:
+        return []
+
+    boxes = np.concatenate([tile_boxes for tile_boxes, _, _ in detections]).reshape(-1, 4)
+    scores = np.concatenate([tile_scores for _, tile_scores, _ in detections])
+    classes = np.concatenate([tile_classes for _, _, tile_classes in detections])
+
+    with PROFILER.span("merge"):
+        keep = _non_maximum_suppression(boxes, scores, classes, iou_threshold)
+
+    return [
+        {"box": [round(value, 2) for value in boxes[idx].tolist()], "confidence": round(float(scores[idx]), 4), "class": int(classes[idx])}
+        for idx in keep
+    ]
+
+def _write_detections(output, image_path: str, image: dict, iou_threshold: float) -> None:
+
+    detections = _merge_detections(image["detections"], iou_threshold)
+
+    with PROFILER.span("write"):
+        output.write(json.dumps({"image": image_path, "width": image["shape"][1], "height": image["shape"][0], "detections": detections}) + "\n")
+        output.flush()
+
+    PROFILER.count("images detected")
+    PROFILER.count("detections", len(detections))
+
+def main():
+
+    program_arguments = _parse_arguments()
+
+    image_paths = _list_images(program_arguments["input"])
+
+    finished = _finished_images(program_arguments["output"]) if program_arguments["resume"] else set()
+    image_paths = [image_path for image_path in image_paths if image_path not in finished]
+
+    print(f"Detecting crocodiles in {len(image_paths)} images, {len(finished)} already done")
+
+    with PROFILER.span("model loading"):
+        model = YOLO(program_arguments["model"])
+
+    # Decoding and tiling run ahead in their own threads while the model works through the batches
+    tile_queue = queue.Queue(maxsize=2*program_arguments["workers"])
+
+    producer = Thread(target=_produce_tiles, args=(image_paths, tile_queue, program_arguments), daemon=True)
+    producer.start()
+
+    images = {}
+    pending_tiles = []
+    failures = 0
+
+    with open(program_arguments["output"], "a" if program_arguments["resume"] else "w") as output:
+
+        while True:
+
+            item = tile_queue.get()
+
+            if isinstance(item, Exception):
+                raise item
+
+            if item is not None:
+
+                image_path, shape, tiles, windows = item
+
+                if shape is None:
+                    print(f"Could not read - {image_path}")
+                    failures += 1
+                    continue
+
+                images[image_path] = {"shape": shape, "remaining": len(tiles), "detections": []}
+                pending_tiles += [(image_path, tile, window) for tile, window in zip(tiles, windows)]
+
+            # Tiles of consecutive images share batches, the last batch may be smaller
+            while len(pending_tiles) >= program_arguments["batch"] or (item is None and len(pending_tiles) > 0):
+
+                batch = pending_tiles[:program_arguments["batch"]]
+                pending_tiles = pending_tiles[program_arguments["batch"]:]
+
+                detections = _detect(
+                    model,
+                    [tile for _, tile, _ in batch],
+                    [window for _, _, window in batch],
+                    [images[image_path]["shape"] for image_path, _, _ in batch],
+                    program_arguments,
+                )
+
+                for (image_path, _, _), tile_detections in zip(batch, detections):
+                    images[image_path]["detections"].append(tile_detections)
+                    images[image_path]["remaining"] -= 1
+
+                # Images are written in input order as soon as all their tiles are done
+                while len(images) > 0 and images[next(iter(images))]["remaining"] == 0:
+                    image_path = next(iter(images))
+                    _write_detections(output, image_path, images.pop(image_path), program_arguments["iou"])
+
+            if item is None:
+                break
+
+    producer.join()
+
+    print(f"Detections saved to - {program_arguments['output']}")
+
+    if failures > 0:
+        print(f"{failures} images could not be read")
+
+    _report_profile(program_arguments)
+
+if __name__ == "__main__" :
+    main()
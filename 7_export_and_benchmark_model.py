@@ -0,0 +1,318 @@
+import argparse, os, re, csv, json, time, shutil, importlib
+import numpy as np
+import cv2
+import onnx
+import onnxruntime
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from ultralytics import YOLO
+from ultralytics.models.yolo.detect import DetectionValidator
+import ultralytics.data.build as ultralytics_build
+
+from _utils import _DatasetReader, _is_shard_dataset, _add_profile_arguments, _enable_profiler, _report_profile, _print_table, PROFILER
+
+# Validation reads packed datasets with the same dataset class as training
+train_YOLO_network = importlib.import_module("5_train_YOLO_network")
+
+IMAGE_SIZE = train_YOLO_network.IMAGE_SIZE
+PADDING_VALUE = 114
+METRICS = ["metrics/mAP50(B)", "metrics/mAP50-95(B)"]
+
+def _parse_arguments() -> dict:
+
+    parser = argparse.ArgumentParser("Export and Benchmark Model")
+
+    parser.add_argument(
+        "-m", "--models",
+        help="Trained weights files (.pt) to export and compare",
+        nargs="+",
+        required=True,
+    )
+
+    parser.add_argument(
+        "-d", "--dataset",
+        help="Dataset whose validation split is used for calibration and the mAP",
+        required=True,
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="Directory where the exported models and the report are stored (default: exported_models)",
+        default="exported_models"
+    )
+
+    parser.add_argument(
+        "--int8",
+        help="Also quantize every model to INT8, calibrated on validation images",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--calibration_images",
+        help="Number of validation images used to calibrate the INT8 quantization (default: 100)",
+        type=int,
+        default=100,
+    )
+
+    parser.add_argument(
+        "--batch_sizes",
+        help="Batch sizes at which the latency is measured (default: 1 8)",
+        nargs="+",
+        type=int,
+        default=[1, 8],
+    )
+
+    parser.add_argument(
+        "--threads",
+        help=f"Numbers of CPU threads with which the latency is measured (default: 1 {os.cpu_count()})",
+        nargs="+",
+        type=int,
+        default=sorted({1, os.cpu_count()}),
+    )
+
+    parser.add_argument(
+        "--runs",
+        help="Number of timed runs per batch size and thread count (default: 20)",
+        type=int,
+        default=20,
+    )
+
+    parser.add_argument(
+        "--warmup",
+        help="Number of untimed runs before the timed runs (default: 3)",
+        type=int,
+        default=3,
+    )
+
+    _add_profile_arguments(parser)
+
+    args = vars(parser.parse_args())
+
+    _enable_profiler(args)
+
+    args["models"] = [os.path.abspath(model) for model in args["models"]]
+    args["dataset"] = os.path.abspath(args["dataset"])
+    args["output"] = os.path.abspath(args["output"])
+
+    for model in args["models"]:
+        if not os.path.exists(model):
+            print(f"Model - {model} - does not exist")
+            exit()
+
+    if not os.path.exists(os.path.join(args["dataset"], "data.yaml")):
+        print(f"Dataset - {args['dataset']} - is not valid")
+        exit()
+
+    os.makedirs(args["output"], exist_ok=True)
+
+    return args
+
+def _model_names(models: list) -> list:
+
+    names = [os.path.splitext(os.path.basename(model))[0] for model in models]
+
+    if len(set(names)) == len(names):
+        return names
+
+    # Weights of different trainings share names like best.pt, so the directories that differ are used instead
+    common = os.path.commonpath(models)
+
+    return [os.path.splitext(os.path.relpath(model, common))[0].replace(os.sep, "_") for model in models]
+
+def _letterbox(img: np.ndarray, size: int) -> np.ndarray:
+
+    height, width = img.shape[:2]
+    ratio = min(size/height, size/width)
+
+    resized_width, resized_height = round(width*ratio), round(height*ratio)
+
+    if (resized_width, resized_height) != (width, height):
+        img = cv2.resize(img, (resized_width, resized_height), interpolation=cv2.INTER_LINEAR)
+
+    top = (size - resized_height)//2
+    left = (size - resized_width)//2
+
+    img = cv2.copyMakeBorder(img, top, size - resized_height - top, left, size - resized_width - left, cv2.BORDER_CONSTANT, value=(PADDING_VALUE,)*3)
+
+    # BGR HWC to the RGB CHW floats the exported model expects
+    return np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1), dtype=np.float32)/255
+
+def _load_validation_images(dataset: str, count: int) -> np.ndarray:
+
+    reader = _DatasetReader(dataset, "val")
+
+    if len(reader) == 0:
+        print(f"Dataset - {dataset} - has no validation images")
+        exit()
+
+    count = min(count, len(reader))
+
+    with PROFILER.span("calibration images"):
+        return np.stack([_letterbox(reader.read_image(int(len(reader)*I/count)), IMAGE_SIZE) for I in range(count)])
+
+class _CalibrationImages(CalibrationDataReader):
+
+    def __init__(self, input_name: str, images: np.ndarray):
+
+        self.inputs = iter([{input_name: image[None]} for image in images])
+
+    def get_next(self) -> dict:
+
+        return next(self.inputs, None)
+
+class _ShardDetectionValidator(DetectionValidator):
+
+    def build_dataset(self, img_path, mode="val", batch=None):
+
+        yolo_dataset = ultralytics_build.YOLODataset
+        ultralytics_build.YOLODataset = train_YOLO_network._ShardDataset
+
+        try:
+            return super().build_dataset(img_path, mode, batch)
+        finally:
+            ultralytics_build.YOLODataset = yolo_dataset
+
+def _export(model: str, filename: str) -> None:
+
+    with PROFILER.span("export"):
+        exported = YOLO(model).export(format="onnx", imgsz=IMAGE_SIZE, dynamic=True, simplify=True)
+
+    shutil.move(exported, filename)
+
+def _quantize(filename: str, int8_filename: str, images: np.ndarray) -> None:
+
+    preprocessed_filename = os.path.splitext(filename)[0] + "_preprocessed.onnx"
+
+    with PROFILER.span("quantize"):
+
+        quant_pre_process(filename, preprocessed_filename)
+
+        graph = onnx.load(preprocessed_filename).graph
+
+        # The detection head decodes the boxes, quantizing it costs most of the accuracy for little speed
+        layers = [int(match.group(1)) for match in (re.match(r"/model\.(\d+)/", node.name) for node in graph.node) if match is not None]
+        head = f"/model.{max(layers)}/" if len(layers) > 0 else None
+
+        quantize_static(
+            preprocessed_filename,
+            int8_filename,
+            _CalibrationImages(graph.input[0].name, images),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            nodes_to_exclude=[node.name for node in graph.node if head is not None and node.name.startswith(head)],
+        )
+
+    os.remove(preprocessed_filename)
+
+def _validate(model: str, name: str, program_arguments: dict) -> dict:
+
+    validator = _ShardDetectionValidator if _is_shard_dataset(program_arguments["dataset"]) else None
+
+    with PROFILER.span("validation"):
+        metrics = YOLO(model, task="detect").val(
+            validator=validator,
+            data=os.path.join(program_arguments["dataset"], "data.yaml"),
+            imgsz=IMAGE_SIZE,
+            batch=1,
+            device="cpu",
+            plots=False,
+            project=program_arguments["output"],
+            name=f"val_{name}",
+            exist_ok=True,
+        )
+
+    return {metric: float(metrics.results_dict[metric]) for metric in METRICS}
+
+def _benchmark(filename: str, images: np.ndarray, batch_size: int, threads: int, program_arguments: dict) -> dict:
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    session = onnxruntime.InferenceSession(filename, options, providers=["CPUExecutionProvider"])
+
+    inputs = {session.get_inputs()[0].name: np.stack([images[idx % len(images)] for idx in range(batch_size)])}
+
+    for _ in range(program_arguments["warmup"]):
+        session.run(None, inputs)
+
+    timings = []
+
+    for _ in range(program_arguments["runs"]):
+
+        start = time.perf_counter()
+        session.run(None, inputs)
+        timings.append(time.perf_counter() - start)
+
+    PROFILER.add_time("latency runs", sum(timings), len(timings))
+
+    return {
+        "latency_ms": float(np.median(timings))*1000,
+        "p90_latency_ms": float(np.percentile(timings, 90))*1000,
+        "images_per_second": batch_size/float(np.median(timings)),
+    }
+
+def _write_report(rows: list, program_arguments: dict) -> None:
+
+    columns = ["model", "format", "batch", "threads", "latency_ms", "p90_latency_ms", "images_per_second"] + METRICS + ["mAP50 change"]
+
+    with open(os.path.join(program_arguments["output"], "report.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(os.path.join(program_arguments["output"], "report.json"), "w") as f:
+        json.dump({"arguments": program_arguments, "results": rows}, f, indent=2)
+
+    _print_table(rows, columns)
+
+    print(f"Report saved to - {os.path.join(program_arguments['output'], 'report.csv')}")
+
+def main():
+
+    program_arguments = _parse_arguments()
+
+    images = _load_validation_images(program_arguments["dataset"], program_arguments["calibration_images"])
+
+    rows = []
+
+    for model, name in zip(program_arguments["models"], _model_names(program_arguments["models"])):
+
+        print(f"Exporting - {model}")
+
+        model_directory = os.path.join(program_arguments["output"], name)
+        os.makedirs(model_directory, exist_ok=True)
+
+        formats = {"onnx": os.path.join(model_directory, f"{name}.onnx")}
+
+        _export(model, formats["onnx"])
+
+        if program_arguments["int8"]:
+            formats["onnx int8"] = os.path.join(model_directory, f"{name}_int8.onnx")
+            _quantize(formats["onnx"], formats["onnx int8"], images)
+
+        # The original weights are the reference every exported format is compared against
+        reference = _validate(model, f"{name}_pt", program_arguments)
+        rows.append(dict(model=name, format="pt", **reference))
+
+        for model_format, filename in formats.items():
+
+            metrics = _validate(filename, f"{name}_{model_format.replace(' ', '_')}", program_arguments)
+            change = metrics["metrics/mAP50(B)"] - reference["metrics/mAP50(B)"]
+
+            for batch_size in program_arguments["batch_sizes"]:
+                for threads in program_arguments["threads"]:
+
+                    print(f"Benchmarking - {name} {model_format} - batch {batch_size}, {threads} threads")
+
+                    latency = _benchmark(filename, images, batch_size, threads, program_arguments)
+                    rows.append(dict(model=name, format=model_format, batch=batch_size, threads=threads, **latency, **metrics, **{"mAP50 change": change}))
+
+    _write_report(rows, program_arguments)
+    _report_profile(program_arguments)
+
+if __name__ == "__main__" :
+    main()
@@ -1,121 +1,1944 @@
-import os, shutil, json, cv2
+import os, re, shutil, json, csv, time, cv2, threading, hashlib, tarfile, zipfile
 import numpy as np
+from functools import lru_cache
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
-def _load_json_file(filename: str) -> str:
+try:
+    import openslide
+except (ImportError, OSError):
+    openslide = None
 
-    if not os.path.exists(filename):
+class _Span:
+
+    def __init__(self, profiler, name: str):
+
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.profiler.add_time(self.name, time.perf_counter() - self.start)
+
+class _Profiler:
+
+    # Disabled spans are a shared no-op context, so instrumented code costs one attribute check
+    _no_span = nullcontext()
+
+    def __init__(self):
+
+        self.enabled = False
+        self.started = time.perf_counter()
+
+        self.spans = {}
+        self.counters = {}
+
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+
+        self.enabled = True
+        self.started = time.perf_counter()
+
+    def span(self, name: str):
+
+        if not self.enabled:
+            return self._no_span
+
+        return _Span(self, name)
+
+    def add_time(self, name: str, seconds: float, calls: int = 1) -> None:
+
+        with self._lock:
+
+            span = self.spans.setdefault(name, [0, 0.0])
+            span[0] += calls
+            span[1] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def collect(self) -> dict:
+
+        with self._lock:
+
+            results = {"spans": self.spans, "counters": self.counters}
+            self.spans = {}
+            self.counters = {}
+
+        return results
+
+    def merge(self, results: dict) -> None:
+
+        for name, (calls, seconds) in results["spans"].items():
+            self.add_time(name, seconds, calls)
+
+        for name, value in results["counters"].items():
+            self.count(name, value)
+
+    def report(self, filename: str = None) -> None:
+
+        wall_time = time.perf_counter() - self.started
+        span_time = sum(seconds for _, seconds in self.spans.values())
+
+        print(f"{'phase':<28}{'calls':>10}{'seconds':>12}{'ms/call':>10}{'share':>8}")
+
+        for name, (calls, seconds) in sorted(self.spans.items(), key=lambda item: -item[1][1]):
+            print(f"{name:<28}{calls:>10}{seconds:>12.3f}{1000*seconds/calls:>10.3f}{100*seconds/max(span_time, 1e-9):>7.1f}%")
+
+        print(f"{'wall time':<28}{'':>10}{wall_time:>12.3f}")
+
+        for name, value in sorted(self.counters.items()):
+            print(f"{name:<28}{value:>22}")
+
+        if filename is None:
+            return
+
+        if filename.endswith(".csv"):
+
+            with open(filename, "w", newline="") as f:
+
+                writer = csv.writer(f)
+                writer.writerow(["kind", "name", "calls", "seconds", "value"])
+                writer.writerow(["wall", "wall time", "", wall_time, ""])
+
+                for name, (calls, seconds) in self.spans.items():
+                    writer.writerow(["span", name, calls, seconds, ""])
+
+                for name, value in self.counters.items():
+                    writer.writerow(["counter", name, "", "", value])
+
+        else:
+
+            with open(filename, "w") as f:
+                json.dump({"wall_time": wall_time, "spans": self.spans, "counters": self.counters}, f, indent=2)
+
+        print(f"Profile saved to - {filename}")
+
+    def _after_fork(self) -> None:
+
+        # A forked worker starts with a copy of the parent's results, which the parent already holds
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+PROFILER = _Profiler()
+
+os.register_at_fork(after_in_child=PROFILER._after_fork)
+
+def _add_profile_arguments(parser) -> None:
+
+    parser.add_argument(
+        "--profile",
+        help="Print how much time every phase took, and save it to the given .json or .csv file",
+        nargs="?",
+        const="",
+        default=None,
+    )
+
+def _enable_profiler(program_arguments: dict) -> None:
+
+    if program_arguments.get("profile") is not None and not PROFILER.enabled:
+        PROFILER.enable()
+
+def _report_profile(program_arguments: dict) -> None:
+
+    if program_arguments.get("profile") is not None:
+        PROFILER.report(program_arguments["profile"] or None)
+
+def _format_value(value) -> str:
+
+    if value is None:
+        return "-"
+
+    if isinstance(value, float):
+        return f"{value:.4f}" if abs(value) < 10 else f"{value:.1f}"
+
+    return str(value)
+
+def _print_table(rows: list, columns: list) -> None:
+
+    cells = [[_format_value(row.get(column)) for column in columns] for row in rows]
+    widths = [max([len(column)] + [len(row[idx]) for row in cells]) for idx, column in enumerate(columns)]
+
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+
+    for row in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def _annotation_index_is_current(stats: dict, directory: str) -> bool:
+
+    source_filename = os.path.join(directory, "source.json")
+
+    if not os.path.exists(source_filename):
+        return False
+
+    with open(source_filename, "r") as f:
+        source = json.load(f)
+
+    return source == stats
+
+def _build_annotation_index(raw_data, directory: str) -> None:
+
+    stats = raw_data.stats("annotations.json")
+    annotations = json.loads(raw_data.read("annotations.json"))
+
+    filenames = list(annotations.keys())
+
+    x_points = []
+    y_points = []
+    polygon_offsets = [0]
+    image_offsets = [0]
+
+    for image_filename in filenames:
+
+        for polygon in annotations[image_filename]["polygons"]:
+
+            x_points.extend(polygon[0])
+            y_points.extend(polygon[1])
+            polygon_offsets.append(len(x_points))
+
+        image_offsets.append(len(polygon_offsets) - 1)
+
+    coordinates = np.array([x_points, y_points], dtype=np.float64).T.reshape(-1, 2)
+
+    if np.array_equal(coordinates, np.round(coordinates)) and np.all(np.abs(coordinates) < 2**31):
+        coordinates = coordinates.astype(np.int32)
+
+    temporary_directory = directory + ".tmp"
+
+    if os.path.exists(temporary_directory):
+        shutil.rmtree(temporary_directory)
+
+    os.makedirs(temporary_directory)
+
+    np.save(os.path.join(temporary_directory, "coordinates.npy"), coordinates)
+    np.save(os.path.join(temporary_directory, "polygon_offsets.npy"), np.array(polygon_offsets, dtype=np.int64))
+    np.save(os.path.join(temporary_directory, "image_offsets.npy"), np.array(image_offsets, dtype=np.int64))
+
+    with open(os.path.join(temporary_directory, "filenames.json"), "w") as f:
+        json.dump(filenames, f)
+
+    with open(os.path.join(temporary_directory, "source.json"), "w") as f:
+        json.dump(stats, f)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+
+    os.rename(temporary_directory, directory)
+
+def _load_annotation_index(raw_data, fallback_directory: str) -> str:
+
+    filename = raw_data.path("annotations.json")
+
+    if not raw_data.exists("annotations.json"):
         print(f"Annotation file - {filename} - does not exist")
         exit()
 
-    with open(filename, "rb") as json_file:
-        output = json.loads(json_file.read())
-        json_file.close()
+    directories = [raw_data.annotation_index_directory(), os.path.join(fallback_directory, ".annotations.index")]
+
+    for directory in directories:
+
+        if _annotation_index_is_current(raw_data.stats("annotations.json"), directory):
+            return directory
+
+    for directory in directories:
+
+        try:
+            print(f"Building annotation index - {directory}")
+            _build_annotation_index(raw_data, directory)
+            return directory
+
+        except OSError:
+            print(f"Could not write annotation index - {directory}")
+
+    print(f"No annotation index could be created for - {filename}")
+    exit()
+
+@lru_cache(maxsize=None)
+def _open_annotation_index(directory: str) -> dict:
+
+    with open(os.path.join(directory, "filenames.json"), "r") as f:
+        filenames = json.load(f)
+
+    return {
+        "filenames": filenames,
+        "coordinates": np.load(os.path.join(directory, "coordinates.npy"), mmap_mode="r"),
+        "polygon_offsets": np.load(os.path.join(directory, "polygon_offsets.npy"), mmap_mode="r"),
+        "image_offsets": np.load(os.path.join(directory, "image_offsets.npy"), mmap_mode="r"),
+    }
+
+def _image_polygon_points(annotation_index: dict, image_idx: int) -> tuple:
+
+    first_polygon, last_polygon = annotation_index["image_offsets"][image_idx:image_idx + 2]
+
+    offsets = np.asarray(annotation_index["polygon_offsets"][first_polygon:last_polygon + 1])
+    points = np.asarray(annotation_index["coordinates"][offsets[0]:offsets[-1]])
+
+    return points, offsets - offsets[0]
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+def _is_archive(path: str) -> bool:
+
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+class _RawDataReader:
+
+    # Reads annotations.json and the renders from a directory or straight from a .zip or .tar archive
+    def __init__(self, path: str):
+
+        self.path_name = path
+        self.archive = None
+        self.random_access = True
+
+        self._handle = None
+        self._handle_pid = None
+        self._members = {}
+
+        if not _is_archive(path):
+            return
+
+        if zipfile.is_zipfile(path):
+
+            self.archive = "zip"
+
+            with zipfile.ZipFile(path) as archive:
+                members = {info.filename: info for info in archive.infolist() if not info.is_dir()}
+
+        else:
+
+            # Only uncompressed tar files store every member at a fixed offset that can be read directly
+            try:
+                with tarfile.open(path, "r:") as archive:
+                    members = {info.name: info for info in archive.getmembers() if info.isfile()}
+
+                self.archive = "tar"
+
+            except tarfile.ReadError:
+
+                with tarfile.open(path, "r:*") as archive:
+                    members = {info.name: info for info in archive.getmembers() if info.isfile()}
+
+                self.archive = "compressed tar"
+                self.random_access = False
+
+        # Releases often wrap everything in one folder, whose annotations.json marks the root
+        annotation_members = sorted((member for member in members if os.path.basename(member) == "annotations.json"), key=len)
+        self.root = os.path.dirname(annotation_members[0]) if len(annotation_members) > 0 else ""
+
+        self._members = {self._relative_name(member): info for member, info in members.items() if self._relative_name(member) is not None}
+
+    def __getstate__(self) -> dict:
+
+        state = self.__dict__.copy()
+        state["_handle"] = None
+
+        return state
+
+    def _relative_name(self, member: str) -> str:
 
-    return output   
+        if self.root == "":
+            return member
+
+        if not member.startswith(self.root + "/"):
+            return None
+
+        return member[len(self.root) + 1:]
+
+    def path(self, name: str) -> str:
+
+        if self.archive is None:
+            return os.path.join(self.path_name, name)
+
+        return f"{self.path_name}:{name}"
+
+    def annotation_index_directory(self) -> str:
+
+        if self.archive is None:
+            return os.path.join(self.path_name, "annotations.index")
+
+        for extension in ARCHIVE_EXTENSIONS:
+            if self.path_name.lower().endswith(extension):
+                return self.path_name[:-len(extension)] + ".annotations.index"
+
+    def exists(self, name: str) -> bool:
+
+        if self.archive is None:
+            return os.path.exists(self.path(name))
+
+        return name in self._members
+
+    def stats(self, name: str) -> dict:
+
+        if self.archive is None:
+            stats = os.stat(self.path(name))
+            return {"size": stats.st_size, "mtime_ns": stats.st_mtime_ns}
+
+        info = self._members[name]
+
+        if self.archive == "zip":
+            return {"size": info.file_size, "mtime_ns": int(time.mktime(info.date_time + (0, 0, -1)))*10**9, "crc": info.CRC}
+
+        return {"size": info.size, "mtime_ns": int(info.mtime)*10**9}
+
+    def read(self, name: str) -> bytes:
+
+        with PROFILER.span("read"):
+
+            if self.archive is None:
+                with open(self.path(name), "rb") as f:
+                    return f.read()
+
+            info = self._members[name]
+
+            # A compressed tar file is decompressed up to the member, which is fine for annotations.json but too slow for every render
+            if self.archive == "compressed tar":
+                with tarfile.open(self.path_name, "r:*") as archive:
+                    return archive.extractfile(info).read()
+
+            # Every process opens the archive itself so workers read in parallel, forked workers must not share the offset of an inherited handle
+            if self._handle is None or self._handle_pid != os.getpid():
+                self._handle = zipfile.ZipFile(self.path_name) if self.archive == "zip" else open(self.path_name, "rb")
+                self._handle_pid = os.getpid()
+
+            if self.archive == "zip":
+                return self._handle.read(info)
+
+            return os.pread(self._handle.fileno(), info.size, info.offset_data)
+
+    def stream(self, names: list):
+
+        # A compressed tar file can only be read front to back, so members come in archive order
+        wanted = set(names)
+
+        with tarfile.open(self.path_name, "r|*") as archive:
+
+            for info in archive:
+
+                name = self._relative_name(info.name)
+
+                if name not in wanted or not info.isfile():
+                    continue
+
+                with PROFILER.span("read"):
+                    content = archive.extractfile(info).read()
+
+                yield name, content
+
+    def signature(self, name: str, cached: dict = None, content: bytes = None) -> tuple:
+
+        if self.archive is None:
+            return _file_signature(self.path(name), cached), content
+
+        stats = self.stats(name)
+
+        if cached is not None and all(cached.get(key) == value for key, value in stats.items()):
+            return cached, content
+
+        if content is None:
+            content = self.read(name)
+
+        return dict(stats, sha256=hashlib.sha256(content).hexdigest()), content
+
+    def read_image(self, name: str, content: bytes = None) -> np.ndarray:
+
+        # Slides stay on disk and are read window by window while cropping
+        if self.archive is None and _is_slide(self.path(name)):
+            return _SlideImage(self.path(name))
+
+        if self.archive is None and content is None:
+            with PROFILER.span("read"):
+                return cv2.imread(self.path(name))
+
+        if content is None:
+            content = self.read(name)
+
+        with PROFILER.span("decode"):
+            return cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+@lru_cache(maxsize=None)
+def _open_raw_data(path: str) -> _RawDataReader:
+
+    return _RawDataReader(path)
+
+def _render_tasks(raw_data: _RawDataReader, image_filenames: list, in_flight: threading.BoundedSemaphore):
+
+    if raw_data.random_access:
+        yield from ((image_idx, image_filename, None) for image_idx, image_filename in enumerate(image_filenames))
+        return
+
+    image_indices = {image_filename: image_idx for image_idx, image_filename in enumerate(image_filenames)}
+
+    # Images that are not in flight yet hold no memory, the consumer releases in_flight for every finished image
+    for image_filename, content in raw_data.stream(image_filenames):
+
+        in_flight.acquire()
+        yield image_indices[image_filename], image_filename, content
 
 def _save_text_file(filename: str, content: str) -> None:
 
-    with open(filename, "w") as f:
-        f.write(content)
-        f.close()
+    with PROFILER.span("write"):
+        with open(filename, "w") as f:
+            f.write(content)
+            f.close()
 
-def _save_image(filename: str, image: np.ndarray):
-    
-    saved = cv2.imwrite(filename, image)
+    PROFILER.count("files written")
+    PROFILER.count("bytes written", len(content))
 
-    if not saved:
-        print(f"Failed to save - {filename}")
+def _save_bytes_file(filename: str, content: bytes) -> None:
 
-def _box_around_polygon(polygon: list):
+    with PROFILER.span("write"):
+        with open(filename, "wb") as f:
+            f.write(content)
 
-    x_points = polygon[0]
-    y_points = polygon[1]
+    PROFILER.count("files written")
+    PROFILER.count("bytes written", len(content))
 
-    left = x_points[0]
-    right = x_points[0]
-    top = y_points[0]
-    bottom = y_points[0]
+IMAGE_FORMATS = {
+    "png": ".png",
+    "jpg": ".jpg",
+    "webp": ".webp",
+}
 
-    for x, y in zip(x_points, y_points):
-        
-        if x < left :
-            left = x
-        elif x > right:
-            right = x
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff")
 
-        if y < top :
-            top = y
-        elif y > bottom :
-            bottom = y
+def _add_writer_arguments(parser) -> None:
 
-    return [left, top, right, bottom]
+    parser.add_argument(
+        "--image_format",
+        help="Format in which images are encoded (default: png)",
+        choices=list(IMAGE_FORMATS.keys()),
+        default="png",
+    )
 
-def _box_within_box(box, larger_box):
+    parser.add_argument(
+        "--png_compression",
+        help="PNG zlib compression level, 0 is fastest and 9 is smallest (default: OpenCV default)",
+        type=int,
+        default=None,
+    )
 
-    l_left, l_top, l_right, l_bottom = larger_box
-    left, top, right, bottom = box
+    parser.add_argument(
+        "--quality",
+        help="JPEG/WebP quality between 0 and 100 (default: 95)",
+        type=int,
+        default=95,
+    )
 
-    width = l_right - l_left
-    height = l_bottom - l_top
+    parser.add_argument(
+        "--writer_threads",
+        help="Number of threads encoding and writing files in the background (default: 4)",
+        type=int,
+        default=4,
+    )
 
-    left = left - l_left
-    right = right - l_left
-    top = top - l_top
-    bottom = bottom - l_top
+def _encode_image(image: np.ndarray, image_format: str = "png", png_compression: int = None, quality: int = 95) -> bytes:
 
-    if left < 0 and right < 0:
-        return None
-    
-    if left > width and right > width: 
-        return None
+    parameters = []
 
-    if top < 0 and bottom < 0:
-        return None
+    if image_format == "png" and png_compression is not None:
+        parameters = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    elif image_format == "jpg":
+        parameters = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif image_format == "webp":
+        parameters = [cv2.IMWRITE_WEBP_QUALITY, quality]
+
+    encoded, buffer = cv2.imencode(IMAGE_FORMATS[image_format], image, parameters)
+
+    if not encoded:
+        raise ValueError(f"Could not encode image as {image_format}")
+
+    return buffer.tobytes()
+
+class _AsyncWriter:
+
+    def __init__(self, image_format: str = "png", png_compression: int = None, quality: int = 95, threads: int = 4, max_pending: int = 16):
+
+        self.image_format = image_format
+        self.png_compression = png_compression
+        self.quality = quality
+        self.extension = IMAGE_FORMATS[image_format]
+
+        self.failures = []
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._pending = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arguments(cls, program_arguments: dict):
+
+        return cls(
+            image_format=program_arguments["image_format"],
+            png_compression=program_arguments["png_compression"],
+            quality=program_arguments["quality"],
+            threads=program_arguments["writer_threads"],
+        )
+
+    def image_filename(self, filename: str) -> str:
+
+        stem, extension = os.path.splitext(filename)
+
+        if extension.lower() in IMAGE_EXTENSIONS:
+            filename = stem
+
+        return filename + self.extension
+
+    def save_image(self, filename: str, image: np.ndarray) -> str:
+
+        filename = self.image_filename(filename)
+        self._submit(filename, self._write_image, filename, image)
+
+        return filename
+
+    def save_text(self, filename: str, content: str) -> None:
+
+        self._submit(filename, _save_text_file, filename, content)
+
+    def save_bytes(self, filename: str, content: bytes) -> None:
+
+        self._submit(filename, _save_bytes_file, filename, content)
+
+    def copy_file(self, source: str, target: str) -> None:
+
+        self._submit(target, self._copy_file, source, target)
+
+    def close(self) -> list:
+
+        self._executor.shutdown(wait=True)
+
+        return self.failures
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+    def _write_image(self, filename: str, image: np.ndarray) -> None:
+
+        with PROFILER.span("encode"):
+            content = _encode_image(image, self.image_format, self.png_compression, self.quality)
+
+        _save_bytes_file(filename, content)
+
+    def _copy_file(self, source: str, target: str) -> None:
+
+        with PROFILER.span("copy"):
+            shutil.copy(source, target)
+
+        PROFILER.count("files copied")
+
+    def _submit(self, filename: str, function, *arguments) -> None:
+
+        self._pending.acquire()
+
+        try:
+            future = self._executor.submit(function, *arguments)
+        except Exception:
+            self._pending.release()
+            raise
+
+        future.add_done_callback(lambda done: self._finish(done, filename))
+
+    def _finish(self, future, filename: str) -> None:
+
+        self._pending.release()
+
+        if future.exception() is not None:
+
+            PROFILER.count("failed writes")
+
+            with self._lock:
+                self.failures.append((filename, str(future.exception())))
+
+def _report_failed_writes(failures: list) -> None:
+
+    if len(failures) == 0:
+        return
+
+    for filename, reason in failures:
+        print(f"Failed to save - {filename} - {reason}")
+
+    print(f"{len(failures)} files could not be saved")
+    exit(1)
+
+def _add_gaussian_blur(img: np.ndarray, sigma: float) -> np.ndarray:
     
-    if top > height and bottom > height: 
-        return None
+    kernel_size = max(3, int(6*sigma + 1))
 
-    o_left = max(left, 0)
-    o_right = min(right, width)
-    o_top = max(top, 0)
-    o_bottom = min(bottom, height)
+    if kernel_size % 2 == 0:
+        kernel_size += 1
 
-    return [o_left, o_top, o_right, o_bottom]
+    return cv2.GaussianBlur(img, (kernel_size, kernel_size), sigmaX=sigma, sigmaY=sigma)
 
-def _generate_YOLO_annotations(boxes: list, size: list) -> str:
+def _add_gaussian_noise(img: np.ndarray, sigma: float, rng: np.random.Generator) -> np.ndarray:   
 
-    annotations = ""
+    # The noise buffer becomes the output, so only a single float32 image is allocated
+    noisy = rng.standard_normal(img.shape, dtype=np.float32)
+    noisy *= sigma
+    noisy += img
 
-    WIDTH, HEIGHT = size
+    np.clip(noisy, 0, 255, out=noisy)
+    np.rint(noisy, out=noisy)
 
-    for box in boxes:
+    return noisy.astype(np.uint8)
 
-        left, top, right, bottom = box
+def _linear_resize_taps(dst_start: int, dst_stop: int, src_size: int, dst_size: int, clamp_fraction: bool) -> tuple:
 
-        width = right - left
-        height = bottom - top
-        center_x = (right + left)/2
-        center_y = (bottom + top)/2
+    # Mirrors the fixed-point INTER_LINEAR coefficients of cv2.resize for 8-bit images
+    scale = 1.0/(dst_size/src_size)
 
-        annotations += f"0 {center_x/WIDTH} {center_y/HEIGHT} {width/WIDTH} {height/HEIGHT}\n"
+    positions = ((np.arange(dst_start, dst_stop, dtype=np.float64) + 0.5)*scale - 0.5).astype(np.float32)
+    first = np.floor(positions).astype(np.int64)
+    fraction = positions - first.astype(np.float32)
 
-    return annotations
+    if clamp_fraction:
+        fraction[first < 0] = 0
+        first[first < 0] = 0
+        fraction[first >= src_size - 1] = 0
+        first[first >= src_size - 1] = src_size - 1
 
-def _create_YOLO_directory(directory: str):
+    weight_first = np.rint((np.float32(1) - fraction)*np.float32(2048)).astype(np.int64)
+    weight_second = np.rint(fraction*np.float32(2048)).astype(np.int64)
 
-    if os.path.exists(directory):
-        shutil.rmtree(directory)
+    return np.clip(first, 0, src_size - 1), np.clip(first + 1, 0, src_size - 1), weight_first, weight_second
 
-    os.makedirs(directory)
+# Resampling a window in NumPy costs about this many times more per pixel than cv2.resize of the whole frame
+WINDOW_RESAMPLING_COST = 25
 
-    os.makedirs(os.path.join(directory, "images", "train"))
-    os.makedirs(os.path.join(directory, "images", "val"))
-    os.makedirs(os.path.join(directory, "labels", "train"))
-    os.makedirs(os.path.join(directory, "labels", "val"))
+def _resize_window(image: np.ndarray, size: tuple, window: list) -> np.ndarray:
 
-    data_yaml = f"path: {os.path.abspath(directory)}\ntrain: images/train\nval: images/val\n\nnames:\n  0: crocodile\n"
+    width, height = size
+    left, top, right, bottom = window
 
-    with open(os.path.join(directory, "data.yaml"), "w") as f:
-        f.write(data_yaml)
-        f.close()
+    if image.shape[1] == width and image.shape[0] == height:
+        return image[top:bottom, left:right]
+
+    if image.dtype != np.uint8:
+        return cv2.resize(image, (width, height))[top:bottom, left:right]
+
+    x_taps = _linear_resize_taps(left, right, image.shape[1], width, True)
+    y_first, y_second, y_weight_first, y_weight_second = _linear_resize_taps(top, bottom, image.shape[0], height, False)
+
+    y_min, y_max = y_first.min(), y_second.max() + 1
+
+    return _interpolate_region(image[y_min:y_max], x_taps, (y_first - y_min, y_second - y_min, y_weight_first, y_weight_second))
+
+def _interpolate_region(region: np.ndarray, x_taps: tuple, y_taps: tuple) -> np.ndarray:
+
+    # The taps index into the region, which holds every source pixel the window needs
+    x_first, x_second, x_weight_first, x_weight_second = x_taps
+    y_first, y_second, y_weight_first, y_weight_second = y_taps
+
+    column_shape = (1, -1) + (1,)*(region.ndim - 2)
+    row_shape = (-1,) + (1,)*(region.ndim - 1)
+
+    # Every intermediate fits in int32: rows are at most 255*2048 and the vertical products at most 2048*32640
+    rows = np.take(region, x_first, axis=1).astype(np.int32)
+    rows *= x_weight_first.astype(np.int32).reshape(column_shape)
+
+    second = np.take(region, x_second, axis=1).astype(np.int32)
+    second *= x_weight_second.astype(np.int32).reshape(column_shape)
+
+    rows += second
+    rows >>= 4
+
+    output = rows[y_first]
+    output *= y_weight_first.astype(np.int32).reshape(row_shape)
+    output >>= 16
+
+    second = rows[y_second]
+    second *= y_weight_second.astype(np.int32).reshape(row_shape)
+    second >>= 16
+
+    output += second
+    output += 2
+    output >>= 2
+
+    return output.astype(np.uint8)
+
+def _resize_windows(image: np.ndarray, size: tuple, windows: list) -> list:
+
+    width, height = size
+
+    if isinstance(image, _SlideImage):
+        return [image.resize_window(size, window) for window in windows]
+
+    window_area = sum((right - left)*(bottom - top) for left, top, right, bottom in windows)
+
+    # Both paths give identical pixels, so only the cheaper one is used
+    if len(windows) == 0 or window_area*WINDOW_RESAMPLING_COST < width*height:
+        return [_resize_window(image, size, window) for window in windows]
+
+    resized = cv2.resize(image, (width, height))
+
+    return [resized[top:bottom, left:right] for left, top, right, bottom in windows]
+
+SLIDE_EXTENSIONS = (".svs", ".tif", ".tiff", ".ndpi", ".scn", ".mrxs", ".vms", ".vmu", ".svslide", ".bif")
+
+def _is_slide(filename: str) -> bool:
+
+    if openslide is None or not filename.lower().endswith(SLIDE_EXTENSIONS):
+        return False
+
+    # Plain TIFFs are not tiled and are decoded as a whole like any other image
+    return openslide.OpenSlide.detect_format(filename) is not None
+
+class _SlideImage:
+
+    # A tiled or pyramidal image of which only the windows of the crops are ever read
+    def __init__(self, filename: str):
+
+        self.slide = openslide.OpenSlide(filename)
+
+        width, height = self.slide.dimensions
+        self.shape = (height, width, 3)
+
+    def resize_window(self, size: tuple, window: list) -> np.ndarray:
+
+        width, height = size
+        left, top, right, bottom = window
+
+        # The smallest pyramid level that is still at least as large as the scaled image is resampled
+        level = self.slide.get_best_level_for_downsample(self.shape[1]/width)
+        level_width, level_height = self.slide.level_dimensions[level]
+
+        if (level_width, level_height) == (width, height):
+            return self._read_region(level, left, top, right - left, bottom - top)
+
+        x_first, x_second, x_weight_first, x_weight_second = _linear_resize_taps(left, right, level_width, width, True)
+        y_first, y_second, y_weight_first, y_weight_second = _linear_resize_taps(top, bottom, level_height, height, False)
+
+        x_min, x_max = x_first.min(), x_second.max() + 1
+        y_min, y_max = y_first.min(), y_second.max() + 1
+
+        region = self._read_region(level, x_min, y_min, x_max - x_min, y_max - y_min)
+
+        return _interpolate_region(
+            region,
+            (x_first - x_min, x_second - x_min, x_weight_first, x_weight_second),
+            (y_first - y_min, y_second - y_min, y_weight_first, y_weight_second),
+        )
+
+    def _read_region(self, level: int, left: int, top: int, width: int, height: int) -> np.ndarray:
+
+        downsample = self.slide.level_downsamples[level]
+
+        # OpenSlide places regions in level 0 coordinates and returns RGBA
+        with PROFILER.span("read"):
+            region = np.asarray(self.slide.read_region((int(round(left*downsample)), int(round(top*downsample))), level, (int(width), int(height))))
+
+        PROFILER.count("pixels read", int(width)*int(height))
+
+        return cv2.cvtColor(region, cv2.COLOR_RGBA2BGR)
+
+def _boxes_around_polygon_points(points: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+
+    if len(offsets) < 2:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    starts = offsets[:-1]
+
+    return np.stack([
+        np.minimum.reduceat(points[:, 0], starts),
+        np.minimum.reduceat(points[:, 1], starts),
+        np.maximum.reduceat(points[:, 0], starts),
+        np.maximum.reduceat(points[:, 1], starts),
+    ], axis=1)
+
+def _scale_boxes(boxes: np.ndarray, scale: float) -> np.ndarray:
+
+    return np.rint(boxes*scale).astype(np.int64)
+
+def _boxes_within_crops(boxes: np.ndarray, crops: np.ndarray) -> tuple:
+
+    boxes = np.asarray(boxes).reshape(1, -1, 4)
+    crops = np.asarray(crops).reshape(-1, 1, 4)
+
+    width = crops[..., 2] - crops[..., 0]
+    height = crops[..., 3] - crops[..., 1]
+
+    left = boxes[..., 0] - crops[..., 0]
+    right = boxes[..., 2] - crops[..., 0]
+    top = boxes[..., 1] - crops[..., 1]
+    bottom = boxes[..., 3] - crops[..., 1]
+
+    outside = (left < 0) & (right < 0)
+    outside |= (left > width) & (right > width)
+    outside |= (top < 0) & (bottom < 0)
+    outside |= (top > height) & (bottom > height)
+
+    clipped = np.stack([
+        np.maximum(left, 0),
+        np.maximum(top, 0),
+        np.minimum(right, width),
+        np.minimum(bottom, height),
+    ], axis=-1)
+
+    return clipped, ~outside
+
+def _YOLO_annotation_lines(boxes: np.ndarray, size: list) -> list:
+
+    WIDTH, HEIGHT = size
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+    values = np.stack([
+        (boxes[:, 2] + boxes[:, 0])/2/WIDTH,
+        (boxes[:, 3] + boxes[:, 1])/2/HEIGHT,
+        (boxes[:, 2] - boxes[:, 0])/WIDTH,
+        (boxes[:, 3] - boxes[:, 1])/HEIGHT,
+    ], axis=1)
+
+    return [f"0 {center_x} {center_y} {width} {height}\n" for center_x, center_y, width, height in values.tolist()]
+
+def _generate_YOLO_annotations_for_crops(boxes: np.ndarray, crops: np.ndarray, size: list) -> list:
+
+    clipped, contained = _boxes_within_crops(boxes, crops)
+
+    lines = _YOLO_annotation_lines(clipped[contained], size)
+
+    ends = np.cumsum(contained.sum(axis=1))
+    starts = ends - contained.sum(axis=1)
+
+    return ["".join(lines[start:end]) for start, end in zip(starts.tolist(), ends.tolist())]
+
+def _crop_free_space(boxes: np.ndarray, size: tuple, crop_size: tuple) -> tuple:
+
+    # Cells of the compressed grid of crop origins, weighted by how many origins they hold
+    # and zeroed wherever a crop starting there would overlap any box
+    width, height = size
+    crop_width, crop_height = crop_size
+
+    max_x = max(width - crop_width + 1, 0)
+    max_y = max(height - crop_height + 1, 0)
+
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+
+    x_start = np.clip(boxes[:, 0] - crop_width, 0, max_x)
+    x_stop = np.clip(boxes[:, 2] + 1, 0, max_x)
+    y_start = np.clip(boxes[:, 1] - crop_height, 0, max_y)
+    y_stop = np.clip(boxes[:, 3] + 1, 0, max_y)
+
+    x_edges = np.unique(np.concatenate([[0, max_x], x_start, x_stop]))
+    y_edges = np.unique(np.concatenate([[0, max_y], y_start, y_stop]))
+
+    x_start, x_stop = np.searchsorted(x_edges, x_start), np.searchsorted(x_edges, x_stop)
+    y_start, y_stop = np.searchsorted(y_edges, y_start), np.searchsorted(y_edges, y_stop)
+
+    coverage = np.zeros((len(y_edges), len(x_edges)), dtype=np.int64)
+
+    np.add.at(coverage, (y_start, x_start), 1)
+    np.add.at(coverage, (y_start, x_stop), -1)
+    np.add.at(coverage, (y_stop, x_start), -1)
+    np.add.at(coverage, (y_stop, x_stop), 1)
+
+    coverage = coverage.cumsum(axis=0).cumsum(axis=1)[:-1, :-1]
+
+    areas = np.outer(np.diff(y_edges), np.diff(x_edges))
+    areas[coverage != 0] = 0
+
+    return x_edges, y_edges, np.cumsum(areas.ravel())
+
+def _sample_free_crops(free_space: tuple, crop_size: tuple, count: int, rng) -> np.ndarray:
+
+    x_edges, y_edges, cumulative_areas = free_space
+    crop_width, crop_height = crop_size
+
+    total = int(cumulative_areas[-1]) if len(cumulative_areas) > 0 else 0
+
+    picks = np.array(rng.sample(range(total), min(count, total)), dtype=np.int64)
+
+    cells = np.searchsorted(cumulative_areas, picks, side="right")
+    offsets = picks - np.concatenate([[0], cumulative_areas])[cells]
+
+    columns = cells % (len(x_edges) - 1)
+    rows = cells // (len(x_edges) - 1)
+
+    cell_widths = x_edges[columns + 1] - x_edges[columns]
+
+    crop_left = x_edges[columns] + offsets % cell_widths
+    crop_top = y_edges[rows] + offsets // cell_widths
+
+    return np.stack([crop_left, crop_top, crop_left + crop_width, crop_top + crop_height], axis=1).reshape(-1, 4)
+
+def _containing_crop_origins(boxes: np.ndarray, size: tuple, crop_size: tuple) -> np.ndarray:
+
+    # Inclusive range of crop origins [left, top, right, bottom] for which a crop fully contains each box
+    width, height = size
+    crop_width, crop_height = crop_size
+
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+
+    origins = np.stack([
+        np.maximum(boxes[:, 2] - crop_width, 0),
+        np.maximum(boxes[:, 3] - crop_height, 0),
+        np.minimum(boxes[:, 0], width - crop_width),
+        np.minimum(boxes[:, 1], height - crop_height),
+    ], axis=1)
+
+    for box, (left, top, right, bottom) in zip(boxes.tolist(), origins.tolist()):
+        if left > right or top > bottom:
+            raise ValueError(f"Box {box} does not fit in a {crop_width}x{crop_height} crop of a {width}x{height} image")
+
+    return origins
+
+def _plan_cover_crops(boxes: np.ndarray, size: tuple, crop_size: tuple, max_appearances: int, rng) -> np.ndarray:
+
+    crop_width, crop_height = crop_size
+
+    origins = _containing_crop_origins(boxes, size, crop_size)
+
+    # Every cell of the compressed grid of crop origins lies inside or outside each box's range of origins
+    x_edges = np.unique(np.concatenate([origins[:, 0], origins[:, 2] + 1]))
+    y_edges = np.unique(np.concatenate([origins[:, 1], origins[:, 3] + 1]))
+
+    x_start, x_stop = np.searchsorted(x_edges, origins[:, 0]), np.searchsorted(x_edges, origins[:, 2] + 1)
+    y_start, y_stop = np.searchsorted(y_edges, origins[:, 1]), np.searchsorted(y_edges, origins[:, 3] + 1)
+
+    def boxes_per_cell(selected: np.ndarray) -> np.ndarray:
+
+        counts = np.zeros((len(y_edges), len(x_edges)), dtype=np.int64)
+
+        np.add.at(counts, (y_start[selected], x_start[selected]), 1)
+        np.add.at(counts, (y_start[selected], x_stop[selected]), -1)
+        np.add.at(counts, (y_stop[selected], x_start[selected]), -1)
+        np.add.at(counts, (y_stop[selected], x_stop[selected]), 1)
+
+        return counts.cumsum(axis=0).cumsum(axis=1)[:-1, :-1]
+
+    areas = np.outer(np.diff(y_edges), np.diff(x_edges))
+
+    uncovered = np.ones(len(origins), dtype=bool)
+    appearances = np.zeros(len(origins), dtype=np.int64)
+
+    crops = []
+
+    while uncovered.any():
+
+        # Greedy set cover: the crop holds as many uncovered boxes as possible without showing any box too often
+        covered_counts = boxes_per_cell(uncovered)
+        saturated_counts = boxes_per_cell(appearances >= max_appearances)
+
+        # When every crop around a box shows others too often, as few of them as possible are shown once more
+        fewest_saturated = saturated_counts[covered_counts > 0].min()
+        counts = np.where(saturated_counts == fewest_saturated, covered_counts, 0)
+
+        PROFILER.count("appearance limit exceeded", int(fewest_saturated))
+
+        # Any origin of the best cells is equally good, which keeps the placement random
+        best_areas = np.where(counts == counts.max(), areas, 0)
+        crop = _sample_free_crops((x_edges, y_edges, np.cumsum(best_areas.ravel())), crop_size, 1, rng)[0]
+
+        contained = (origins[:, 0] <= crop[0]) & (crop[0] <= origins[:, 2]) & (origins[:, 1] <= crop[1]) & (crop[1] <= origins[:, 3])
+
+        appearances += contained
+        uncovered &= ~contained
+
+        crops.append(crop)
+
+    return np.array(crops, dtype=np.int64).reshape(-1, 4)
+
+def _non_maximum_suppression(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, iou_threshold: float) -> np.ndarray:
+
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Shifting every class to its own region keeps boxes of different classes from suppressing each other
+    boxes = boxes.astype(np.float64) + (classes.astype(np.float64)*(boxes.max() + 1))[:, None]
+    areas = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
+
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+
+    while len(order) > 0:
+
+        best = order[0]
+        keep.append(best)
+
+        rest = order[1:]
+
+        intersection_width = np.clip(np.minimum(boxes[best, 2], boxes[rest, 2]) - np.maximum(boxes[best, 0], boxes[rest, 0]), 0, None)
+        intersection_height = np.clip(np.minimum(boxes[best, 3], boxes[rest, 3]) - np.maximum(boxes[best, 1], boxes[rest, 1]), 0, None)
+        intersection = intersection_width*intersection_height
+
+        iou = intersection/np.maximum(areas[best] + areas[rest] - intersection, 1e-9)
+        order = rest[iou <= iou_threshold]
+
+    return np.array(keep, dtype=np.int64)
+
+DATASET_FORMATS = ["directory", "shards"]
+DATASET_VIEWS = ["copy", "hardlink", "symlink", "filelist"]
+
+def _add_dataset_format_arguments(parser) -> None:
+
+    parser.add_argument(
+        "--output_format",
+        help="Store the output as one file per image and label (directory) or as packed shards (default: directory)",
+        choices=DATASET_FORMATS,
+        default="directory",
+    )
+
+    parser.add_argument(
+        "--shard_size",
+        help="Maximum size of a single shard in MB when writing shards (default: 256)",
+        type=int,
+        default=256,
+    )
+
+def _add_dataset_view_arguments(parser) -> None:
+
+    parser.add_argument(
+        "--view",
+        help="Copy the selected samples, hardlink or symlink them, or only list their paths in train.txt and val.txt (default: copy)",
+        choices=DATASET_VIEWS,
+        default="copy",
+    )
+
+def _create_YOLO_directory(directory: str, output_format: str = "directory", clean: bool = True, view: str = "copy"):
+
+    if clean and os.path.exists(directory):
+        shutil.rmtree(directory)
+
+    os.makedirs(directory, exist_ok=True)
+
+    if output_format == "shards":
+
+        for split in ["train", "val"]:
+            os.makedirs(os.path.join(directory, "shards", split), exist_ok=True)
+            _ShardWriter(os.path.join(directory, "shards", split)).close()
+
+        data_yaml = f"path: {os.path.abspath(directory)}\ntrain: shards/train\nval: shards/val\n\nnames:\n  0: crocodile\n"
+
+    else:
+
+        os.makedirs(os.path.join(directory, "images", "train"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "images", "val"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "labels", "train"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "labels", "val"), exist_ok=True)
+
+        data_yaml = f"path: {os.path.abspath(directory)}\ntrain: images/train\nval: images/val\n\nnames:\n  0: crocodile\n"
+
+        if view == "filelist":
+
+            for split in ["train", "val"]:
+                _save_text_file(os.path.join(directory, f"{split}.txt"), "")
+                _save_text_file(_file_list_names_filename(directory, split), "")
+
+            data_yaml = f"path: {os.path.abspath(directory)}\ntrain: train.txt\nval: val.txt\n\nnames:\n  0: crocodile\n"
+
+    with open(os.path.join(directory, "data.yaml"), "w") as f:
+        f.write(data_yaml)
+        f.close()
+
+def _file_signature(filename: str, cached: dict = None) -> dict:
+
+    stats = os.stat(filename)
+
+    if cached is not None and cached["size"] == stats.st_size and cached["mtime_ns"] == stats.st_mtime_ns:
+        return cached
+
+    digest = hashlib.sha256()
+
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+
+    return {"size": stats.st_size, "mtime_ns": stats.st_mtime_ns, "sha256": digest.hexdigest()}
+
+def _hash_inputs(*inputs) -> str:
+
+    digest = hashlib.sha256()
+
+    for value in inputs:
+
+        if isinstance(value, np.ndarray):
+            value = value.tobytes()
+        elif not isinstance(value, bytes):
+            value = json.dumps(value, sort_keys=True).encode("utf-8")
+
+        digest.update(len(value).to_bytes(8, "little"))
+        digest.update(value)
+
+    return digest.hexdigest()
+
+def _outputs_exist(directory: str, outputs: list) -> bool:
+
+    return all(os.path.exists(os.path.join(directory, output)) for output in outputs)
+
+def _remove_outputs(directory: str, outputs: list) -> None:
+
+    for output in outputs:
+        if os.path.exists(os.path.join(directory, output)):
+            os.remove(os.path.join(directory, output))
+
+class _Manifest:
+
+    # manifest.jsonl is an append-only journal, so an interrupted run keeps every finished entry
+    def __init__(self, directory: str, resume: bool):
+
+        self.directory = directory
+        self.filename = os.path.join(directory, "manifest.jsonl")
+
+        self.settings = {}
+        self.entries = {}
+
+        self._journal = None
+
+        if resume and os.path.exists(self.filename):
+
+            with open(self.filename, "r") as f:
+
+                for line in f:
+
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+
+                    if "settings" in record:
+                        self.settings.update(record["settings"])
+                    else:
+                        self.entries[record["key"]] = record
+
+    def open(self, settings: dict) -> None:
+
+        self.settings.update(settings)
+        self._rewrite()
+
+        self._journal = open(self.filename, "a")
+
+    def is_current(self, key: str, input_hash: str) -> bool:
+
+        entry = self.entries.get(key)
+
+        return entry is not None and entry["hash"] == input_hash and _outputs_exist(self.directory, entry["outputs"])
+
+    def remove(self, key: str) -> None:
+
+        if key in self.entries:
+            _remove_outputs(self.directory, self.entries.pop(key)["outputs"])
+
+    def record(self, entry: dict) -> None:
+
+        self.entries[entry["key"]] = entry
+
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def finish(self, keys: set, subdirectories: list) -> int:
+
+        removed = 0
+
+        for key in [key for key in self.entries if key not in keys]:
+            removed += len(self.entries[key]["outputs"])
+            self.remove(key)
+
+        referenced = set(output for entry in self.entries.values() for output in entry["outputs"])
+
+        for subdirectory in subdirectories:
+
+            for filename in os.listdir(os.path.join(self.directory, subdirectory)):
+
+                output = os.path.join(subdirectory, filename)
+
+                if output not in referenced:
+                    os.remove(os.path.join(self.directory, output))
+                    removed += 1
+
+        self._journal.close()
+        self._rewrite()
+
+        return removed
+
+    def _rewrite(self) -> None:
+
+        temporary_filename = self.filename + ".tmp"
+
+        with open(temporary_filename, "w") as f:
+
+            f.write(json.dumps({"settings": self.settings}) + "\n")
+
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+
+        os.replace(temporary_filename, self.filename)
+
+def _image_seed(seed: int, image_filename: str) -> int:
+
+    digest = hashlib.sha256(f"{seed}/{image_filename}".encode("utf-8")).digest()
+
+    return int.from_bytes(digest[:8], "little")
+
+def _is_shard_dataset(directory: str) -> bool:
+
+    return os.path.isdir(os.path.join(directory, "shards"))
+
+def _is_filelist_dataset(directory: str) -> bool:
+
+    return os.path.isfile(os.path.join(directory, "train.txt"))
+
+def _file_list_names_filename(directory: str, split: str) -> str:
+
+    return os.path.join(directory, f"{split}_names.txt")
+
+def _label_path_for_image(image_path: str) -> str:
+
+    # Same mapping as ultralytics: the last /images/ becomes /labels/ and the extension becomes .txt
+    images, labels = f"{os.sep}images{os.sep}", f"{os.sep}labels{os.sep}"
+
+    return labels.join(image_path.rsplit(images, 1)).rsplit(".", 1)[0] + ".txt"
+
+def _link_file(source: str, target: str, view: str) -> None:
+
+    source = os.path.realpath(source)
+
+    with PROFILER.span("link"):
+
+        if view == "symlink":
+            os.symlink(source, target)
+        else:
+            os.link(source, target)
+
+    PROFILER.count("files linked")
+
+def _parse_YOLO_annotations(content: str) -> np.ndarray:
+
+    rows = [line.split() for line in content.splitlines() if line.strip() != ""]
+
+    for row in rows:
+        if len(row) != 5:
+            raise ValueError(f"Only detection labels with 5 values per line can be packed, found - {' '.join(row)}")
+
+    return np.array(rows, dtype=np.float64).reshape(-1, 5)
+
+def _format_YOLO_annotations(rows: np.ndarray) -> str:
+
+    return "".join(f"{int(row[0])} {row[1]} {row[2]} {row[3]} {row[4]}\n" for row in rows.tolist())
+
+def _image_shape(content: bytes) -> tuple:
+
+    image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+    if image is None:
+        raise ValueError("Could not decode image")
+
+    return image.shape[:2]
+
+class _ShardWriter:
+
+    # index.npy columns: shard, offset, length, first label row, label rows, height, width
+    def __init__(self, split_directory: str, shard_size: int = 256*2**20):
+
+        self.split_directory = split_directory
+        self.shard_size = shard_size
+
+        self.filenames = []
+        self.shards = []
+        self.index = []
+        self.labels = []
+        self.label_count = 0
+
+        self._shard = None
+        self._shard_offset = 0
+        self._written_shards = 0
+        self._referenced_shards = {}
+
+    def add(self, filename: str, content: bytes, annotations: str, shape: tuple = None) -> None:
+
+        if shape is None:
+            shape = _image_shape(content)
+
+        if self._shard is None or (self._shard_offset > 0 and self._shard_offset + len(content) > self.shard_size):
+            self._next_shard()
+
+        self._shard.write(content)
+
+        self._add_entry(filename, len(self.shards) - 1, self._shard_offset, len(content), _parse_YOLO_annotations(annotations), shape)
+
+        self._shard_offset += len(content)
+
+    def add_reference(self, filename: str, shard_filename: str, offset: int, length: int, rows: np.ndarray, shape: tuple, view: str) -> None:
+
+        shard_filename = os.path.realpath(shard_filename)
+
+        if shard_filename not in self._referenced_shards:
+
+            # A filelist view points at the source shard, the link views place a link to it in this split
+            reference = shard_filename
+
+            if view != "filelist":
+                reference = f"linked_{len(self._referenced_shards):05d}.bin"
+                _link_file(shard_filename, os.path.join(self.split_directory, reference), view)
+
+            self._referenced_shards[shard_filename] = len(self.shards)
+            self.shards.append(reference)
+
+        self._add_entry(filename, self._referenced_shards[shard_filename], offset, length, rows, shape)
+
+    def close(self) -> None:
+
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+
+        index = np.array(self.index, dtype=np.int64).reshape(-1, 7)
+        labels = np.concatenate(self.labels) if len(self.labels) > 0 else np.zeros((0, 5), dtype=np.float64)
+
+        np.save(os.path.join(self.split_directory, "index.npy"), index)
+        np.save(os.path.join(self.split_directory, "labels.npy"), labels)
+
+        with open(os.path.join(self.split_directory, "meta.json"), "w") as f:
+            json.dump({"filenames": self.filenames, "shards": self.shards}, f)
+
+    def _next_shard(self) -> None:
+
+        if self._shard is not None:
+            self._shard.close()
+
+        shard_filename = f"shard_{self._written_shards:05d}.bin"
+
+        self._shard = open(os.path.join(self.split_directory, shard_filename), "wb")
+        self._shard_offset = 0
+        self._written_shards += 1
+
+        self.shards.append(shard_filename)
+
+    def _add_entry(self, filename: str, shard: int, offset: int, length: int, rows: np.ndarray, shape: tuple) -> None:
+
+        self.filenames.append(filename)
+        self.index.append([shard, offset, length, self.label_count, len(rows), shape[0], shape[1]])
+        self.labels.append(rows)
+        self.label_count += len(rows)
+
+class _ShardReader:
+
+    def __init__(self, split_directory: str):
+
+        self.split_directory = split_directory
+
+        with open(os.path.join(split_directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+
+        self.filenames = meta["filenames"]
+        self.shards = [os.path.join(split_directory, shard) for shard in meta["shards"]]
+
+        self.index = np.load(os.path.join(split_directory, "index.npy"), mmap_mode="r")
+        self.label_table = np.load(os.path.join(split_directory, "labels.npy"), mmap_mode="r")
+
+        self._files = {}
+
+    def __len__(self) -> int:
+
+        return len(self.filenames)
+
+    def __getstate__(self) -> dict:
+
+        state = self.__dict__.copy()
+        state["_files"] = {}
+
+        return state
+
+    def read(self, idx: int) -> bytes:
+
+        shard, offset, length = self.index[idx, :3].tolist()
+
+        if shard not in self._files:
+            self._files[shard] = open(self.shards[shard], "rb")
+
+        return os.pread(self._files[shard].fileno(), length, offset)
+
+    def location(self, idx: int) -> tuple:
+
+        shard, offset, length = self.index[idx, :3].tolist()
+
+        return self.shards[shard], offset, length
+
+    def labels(self, idx: int) -> np.ndarray:
+
+        first, count = self.index[idx, 3:5].tolist()
+
+        return np.asarray(self.label_table[first:first + count])
+
+    def shape(self, idx: int) -> tuple:
+
+        return tuple(self.index[idx, 5:7].tolist())
+
+    def close(self) -> None:
+
+        for f in self._files.values():
+            f.close()
+
+        self._files = {}
+
+def _metadata_filename(directory: str, split: str) -> str:
+
+    return os.path.join(directory, "metadata", f"{split}.json")
+
+def _load_metadata(directory: str, split: str) -> dict:
+
+    # Maps image filenames to what is known about their origin, e.g. {"source": "render_0.png", "scale": 1.0}
+    if not os.path.exists(_metadata_filename(directory, split)):
+        return {}
+
+    with open(_metadata_filename(directory, split), "r") as f:
+        return json.load(f)
+
+class _DatasetReader:
+
+    def __init__(self, directory: str, split: str):
+
+        self.directory = directory
+        self.split = split
+        self.shards = None
+        self.image_paths = None
+
+        if _is_shard_dataset(directory):
+            self.shards = _ShardReader(os.path.join(directory, "shards", split))
+            self.filenames = list(self.shards.filenames)
+
+        elif _is_filelist_dataset(directory):
+
+            with open(os.path.join(directory, f"{split}.txt"), "r") as f:
+                lines = [line.strip() for line in f if line.strip() != ""]
+
+            self.image_paths = [os.path.normpath(os.path.join(directory, line)) for line in lines]
+            self.filenames = [os.path.basename(path) for path in self.image_paths]
+
+            # The listed paths point at the sources, the names the images were given in this dataset are kept next to the list
+            if os.path.exists(_file_list_names_filename(directory, split)):
+                with open(_file_list_names_filename(directory, split), "r") as f:
+                    self.filenames = [line.strip() for line in f if line.strip() != ""]
+
+            if len(self.filenames) != len(self.image_paths) or len(set(self.filenames)) != len(self.filenames):
+                print(f"File list - {os.path.join(directory, f'{split}.txt')} - does not give every image its own filename")
+                exit()
+
+        else:
+            # Placeholders and other files next to the images are not part of the dataset
+            self.filenames = sorted(filename for filename in os.listdir(os.path.join(directory, "images", split)) if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS)
+
+        self._metadata = None
+
+    def __len__(self) -> int:
+
+        return len(self.filenames)
+
+    def image_path(self, idx: int) -> str:
+
+        if self.image_paths is not None:
+            return self.image_paths[idx]
+
+        return os.path.join(self.directory, "images", self.split, self.filenames[idx])
+
+    def label_path(self, idx: int) -> str:
+
+        return _label_path_for_image(self.image_path(idx))
+
+    def read_bytes(self, idx: int) -> bytes:
+
+        with PROFILER.span("read"):
+
+            if self.shards is not None:
+                content = self.shards.read(idx)
+
+            else:
+                with open(self.image_path(idx), "rb") as f:
+                    content = f.read()
+
+        PROFILER.count("bytes read", len(content))
+
+        return content
+
+    def read_image(self, idx: int, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+
+        content = self.read_bytes(idx)
+
+        with PROFILER.span("decode"):
+            return cv2.imdecode(np.frombuffer(content, dtype=np.uint8), flags)
+
+    def read_annotations(self, idx: int) -> str:
+
+        if self.shards is not None:
+            return _format_YOLO_annotations(self.shards.labels(idx))
+
+        if not os.path.exists(self.label_path(idx)):
+            return ""
+
+        with open(self.label_path(idx), "r") as f:
+            return f.read()
+
+    def shape(self, idx: int) -> tuple:
+
+        if self.shards is not None:
+            return self.shards.shape(idx)
+
+        return None
+
+    def metadata(self, idx: int) -> dict:
+
+        if self._metadata is None:
+            self._metadata = _load_metadata(self.directory, self.split)
+
+        return self._metadata.get(self.filenames[idx])
+
+    def signature(self, idx: int, cached: dict = None) -> dict:
+
+        if self.shards is not None:
+            return {"image": {"sha256": _hash_inputs(self.shards.read(idx), self.shards.labels(idx))}}
+
+        cached = cached if cached is not None else {}
+
+        signature = {"image": _file_signature(self.image_path(idx), cached.get("image"))}
+
+        if os.path.exists(self.label_path(idx)):
+            signature["label"] = _file_signature(self.label_path(idx), cached.get("label"))
+
+        return signature
+
+@lru_cache(maxsize=None)
+def _open_dataset_reader(directory: str, split: str) -> _DatasetReader:
+
+    return _DatasetReader(directory, split)
+
+LABEL_INDEX_SOURCE = re.compile(r"^(.*?)(?:_\d+)?$")
+
+def _label_index_source(reader: _DatasetReader) -> dict:
+
+    if reader.shards is not None:
+        files = [os.path.join(reader.shards.split_directory, name) for name in ["meta.json", "index.npy", "labels.npy"]]
+    else:
+        files = [reader.label_path(idx) for idx in range(len(reader))]
+
+    files.append(_metadata_filename(reader.directory, reader.split))
+
+    stats = []
+
+    for filename in files:
+
+        try:
+            file_stats = os.stat(filename)
+            stats.append([file_stats.st_size, file_stats.st_mtime_ns])
+
+        except FileNotFoundError:
+            stats.append(None)
+
+    return {"filenames": _hash_inputs(reader.filenames), "files": _hash_inputs(stats)}
+
+def _label_index_is_current(reader: _DatasetReader, directory: str) -> bool:
+
+    source_filename = os.path.join(directory, "source.json")
+
+    if not os.path.exists(source_filename):
+        return False
+
+    with open(source_filename, "r") as f:
+        source = json.load(f)
+
+    return source == _label_index_source(reader)
+
+def _build_label_index(reader: _DatasetReader, directory: str) -> None:
+
+    source = _label_index_source(reader)
+
+    if reader.shards is not None:
+
+        box_counts = np.asarray(reader.shards.index[:, 4], dtype=np.int32)
+        rows = np.asarray(reader.shards.label_table, dtype=np.float64).reshape(-1, 5)
+
+    else:
+
+        texts = []
+
+        for idx in range(len(reader)):
+
+            try:
+                with open(reader.label_path(idx), "rb") as f:
+                    texts.append(f.read())
+
+            except FileNotFoundError:
+                texts.append(b"")
+
+        PROFILER.count("label files read", len(texts))
+
+        # Every label file is split once, a detection label always has 5 values per box
+        values = [text.split() for text in texts]
+
+        for idx, file_values in enumerate(values):
+            if len(file_values) % 5 != 0:
+                raise ValueError(f"Only detection labels with 5 values per line can be indexed - {reader.label_path(idx)}")
+
+        box_counts = np.array([len(file_values)//5 for file_values in values], dtype=np.int32)
+        rows = np.array([value for file_values in values for value in file_values], dtype=np.float64).reshape(-1, 5)
+
+    metadata = _load_metadata(reader.directory, reader.split)
+
+    sources = []
+    scales = np.full(len(reader), np.nan, dtype=np.float32)
+
+    for idx, filename in enumerate(reader.filenames):
+
+        image_metadata = metadata.get(filename, {})
+
+        # Crops without metadata are named after their render and a counter, e.g. render_0_12.png
+        sources.append(image_metadata.get("source", LABEL_INDEX_SOURCE.match(os.path.splitext(filename)[0]).group(1)))
+
+        if image_metadata.get("scale") is not None:
+            scales[idx] = image_metadata["scale"]
+
+    source_names = sorted(set(sources))
+    source_ids = {source: idx for idx, source in enumerate(source_names)}
+
+    temporary_directory = directory + ".tmp"
+
+    if os.path.exists(temporary_directory):
+        shutil.rmtree(temporary_directory)
+
+    os.makedirs(temporary_directory)
+
+    np.save(os.path.join(temporary_directory, "box_counts.npy"), box_counts)
+    np.save(os.path.join(temporary_directory, "box_offsets.npy"), np.concatenate([[0], np.cumsum(box_counts, dtype=np.int64)]))
+    np.save(os.path.join(temporary_directory, "classes.npy"), rows[:, 0].astype(np.int16))
+    np.save(os.path.join(temporary_directory, "boxes.npy"), rows[:, 1:5].astype(np.float32))
+    np.save(os.path.join(temporary_directory, "sources.npy"), np.array([source_ids[source] for source in sources], dtype=np.int32))
+    np.save(os.path.join(temporary_directory, "scales.npy"), scales)
+
+    with open(os.path.join(temporary_directory, "filenames.json"), "w") as f:
+        json.dump(reader.filenames, f)
+
+    with open(os.path.join(temporary_directory, "sources.json"), "w") as f:
+        json.dump(source_names, f)
+
+    with open(os.path.join(temporary_directory, "source.json"), "w") as f:
+        json.dump(source, f)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+
+    os.rename(temporary_directory, directory)
+
+def _load_label_index(directory: str, split: str) -> dict:
+
+    reader = _DatasetReader(directory, split)
+    index_directory = os.path.join(directory, ".label_index", split)
+
+    if not _label_index_is_current(reader, index_directory):
+
+        print(f"Building label index - {index_directory}")
+
+        with PROFILER.span("label index"):
+            os.makedirs(os.path.dirname(index_directory), exist_ok=True)
+            _build_label_index(reader, index_directory)
+
+    with open(os.path.join(index_directory, "filenames.json"), "r") as f:
+        filenames = json.load(f)
+
+    with open(os.path.join(index_directory, "sources.json"), "r") as f:
+        source_names = json.load(f)
+
+    return {
+        "filenames": filenames,
+        "source_names": source_names,
+        "box_counts": np.load(os.path.join(index_directory, "box_counts.npy"), mmap_mode="r"),
+        "box_offsets": np.load(os.path.join(index_directory, "box_offsets.npy"), mmap_mode="r"),
+        "classes": np.load(os.path.join(index_directory, "classes.npy"), mmap_mode="r"),
+        "boxes": np.load(os.path.join(index_directory, "boxes.npy"), mmap_mode="r"),
+        "sources": np.load(os.path.join(index_directory, "sources.npy"), mmap_mode="r"),
+        "scales": np.load(os.path.join(index_directory, "scales.npy"), mmap_mode="r"),
+    }
+
+class _DatasetWriter:
+
+    def __init__(self, directory: str, split: str, program_arguments: dict):
+
+        self.directory = directory
+        self.split = split
+        self.output_format = program_arguments.get("output_format", "directory")
+        self.view = program_arguments.get("view", "copy")
+
+        self.files = _AsyncWriter(
+            image_format=program_arguments.get("image_format", "png"),
+            png_compression=program_arguments.get("png_compression", None),
+            quality=program_arguments.get("quality", 95),
+            threads=program_arguments.get("writer_threads", 4),
+        )
+
+        self.shards = None
+
+        if self.output_format == "shards":
+            self.shards = _ShardWriter(os.path.join(directory, "shards", split), program_arguments.get("shard_size", 256)*2**20)
+
+        self.file_list = None
+
+        if self.shards is None and self.view == "filelist":
+            self.file_list = []
+
+        self.metadata = {}
+
+    def add_metadata(self, filename: str, metadata: dict) -> None:
+
+        if metadata is not None:
+            self.metadata[filename] = metadata
+
+    def add_image(self, filename: str, image: np.ndarray, annotations: str, metadata: dict = None) -> list:
+
+        filename = self.files.image_filename(filename)
+        self.add_metadata(filename, metadata)
+
+        if self.shards is not None:
+            content = _encode_image(image, self.files.image_format, self.files.png_compression, self.files.quality)
+            self.shards.add(filename, content, annotations, image.shape[:2])
+            return []
+
+        self.files.save_image(os.path.join(self.directory, self._image_output(filename)), image)
+        self._list_output(filename)
+
+        return [self._image_output(filename)] + self._add_label(filename, annotations)
+
+    def add_bytes(self, filename: str, content: bytes, annotations: str, shape: tuple = None, metadata: dict = None) -> list:
+
+        self.add_metadata(filename, metadata)
+
+        if self.shards is not None:
+            self.shards.add(filename, content, annotations, shape)
+            return []
+
+        self.files.save_bytes(os.path.join(self.directory, self._image_output(filename)), content)
+        self._list_output(filename)
+
+        return [self._image_output(filename)] + self._add_label(filename, annotations)
+
+    def add_from(self, reader: _DatasetReader, idx: int, filename: str = None) -> list:
+
+        if filename is None:
+            filename = reader.filenames[idx]
+
+        self.add_metadata(filename, reader.metadata(idx))
+
+        # Views only reference or link the source, which needs the source and output to share a format
+        if self.view != "copy" and (self.shards is None) == (reader.shards is None):
+
+            try:
+                return self._add_view(reader, idx, filename)
+
+            except OSError as error:
+                print(f"Could not {self.view} - {reader.directory} - into - {self.directory} - ({error}), copying instead")
+                self.view = "copy"
+
+        if self.shards is None and reader.shards is None:
+
+            self.files.copy_file(reader.image_path(idx), os.path.join(self.directory, self._image_output(filename)))
+            self._list_output(filename)
+
+            if not os.path.exists(reader.label_path(idx)):
+                return [self._image_output(filename)]
+
+            self.files.copy_file(reader.label_path(idx), os.path.join(self.directory, self._label_output(filename)))
+
+            return [self._image_output(filename), self._label_output(filename)]
+
+        return self.add_bytes(filename, reader.read_bytes(idx), reader.read_annotations(idx), reader.shape(idx))
+
+    def add_label_from(self, reader: _DatasetReader, idx: int, filename: str = None) -> list:
+
+        if filename is None:
+            filename = reader.filenames[idx]
+
+        if not os.path.exists(reader.label_path(idx)):
+            return []
+
+        target = os.path.join(self.directory, self._label_output(filename))
+
+        if self.view in ["hardlink", "symlink"]:
+
+            try:
+                _link_file(reader.label_path(idx), target, self.view)
+                return [self._label_output(filename)]
+
+            except OSError as error:
+                print(f"Could not {self.view} - {reader.directory} - into - {self.directory} - ({error}), copying instead")
+                self.view = "copy"
+
+        self.files.copy_file(reader.label_path(idx), target)
+
+        return [self._label_output(filename)]
+
+    def close(self) -> list:
+
+        failures = self.files.close()
+
+        if self.shards is not None:
+            self.shards.close()
+
+        if self.file_list is not None:
+            _save_text_file(os.path.join(self.directory, f"{self.split}.txt"), "".join(path + "\n" for path, _ in self.file_list))
+            _save_text_file(_file_list_names_filename(self.directory, self.split), "".join(filename + "\n" for _, filename in self.file_list))
+
+        if len(self.metadata) > 0:
+
+            os.makedirs(os.path.dirname(_metadata_filename(self.directory, self.split)), exist_ok=True)
+
+            with open(_metadata_filename(self.directory, self.split), "w") as f:
+                json.dump(self.metadata, f)
+
+        return failures
+
+    def _add_view(self, reader: _DatasetReader, idx: int, filename: str) -> list:
+
+        if self.shards is not None:
+            shard_filename, offset, length = reader.shards.location(idx)
+            self.shards.add_reference(filename, shard_filename, offset, length, reader.shards.labels(idx), reader.shape(idx), self.view)
+            return []
+
+        if self.file_list is not None:
+            self.file_list.append((os.path.realpath(reader.image_path(idx)), filename))
+            return []
+
+        _link_file(reader.image_path(idx), os.path.join(self.directory, self._image_output(filename)), self.view)
+
+        if not os.path.exists(reader.label_path(idx)):
+            return [self._image_output(filename)]
+
+        _link_file(reader.label_path(idx), os.path.join(self.directory, self._label_output(filename)), self.view)
+
+        return [self._image_output(filename), self._label_output(filename)]
+
+    def _add_label(self, filename: str, annotations: str) -> list:
+
+        # Without annotations only the image is written, the label is added separately
+        if annotations is None:
+            return []
+
+        self.files.save_text(os.path.join(self.directory, self._label_output(filename)), annotations)
+
+        return [self._label_output(filename)]
+
+    def _list_output(self, filename: str) -> None:
+
+        if self.file_list is not None:
+            self.file_list.append((os.path.join(self.directory, self._image_output(filename)), filename))
+
+    def _image_output(self, filename: str) -> str:
+
+        return os.path.join("images", self.split, filename)
+
+    def _label_output(self, filename: str) -> str:
+
+        label_name = ".".join(filename.split(".")[:-1]) + ".txt"
 
+        return os.path.join("labels", self.split, label_name)
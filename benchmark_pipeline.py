@@ -0,0 +1,407 @@
+import argparse, os, sys, json, time, random, shutil, platform, subprocess, importlib
+import numpy as np
+import cv2
+
+from _utils import (
+    _boxes_around_polygon_points,
+    _scale_boxes,
+    _generate_YOLO_annotations_for_crops,
+    _crop_free_space,
+    _sample_free_crops,
+    _plan_cover_crops,
+    _resize_window,
+    _resize_windows,
+    _encode_image,
+    _add_gaussian_blur,
+    _add_gaussian_noise,
+)
+
+create_synthetic_dataset = importlib.import_module("1_create_synthetic_dataset")
+
+def _parse_arguments() -> dict:
+
+    parser = argparse.ArgumentParser("Benchmark Pipeline")
+
+    parser.add_argument(
+        "-o", "--output",
+        help="Directory where the fixtures and the datasets of the benchmark are created (default: benchmark)",
+        default="benchmark"
+    )
+
+    parser.add_argument(
+        "-r", "--results",
+        help="JSON file the results are written to (default: benchmark_results.json)",
+        default="benchmark_results.json"
+    )
+
+    parser.add_argument(
+        "--images",
+        help="Number of raw images in the fixture (default: 8)",
+        type=int,
+        default=8,
+    )
+
+    parser.add_argument(
+        "--width",
+        help="Width of the raw images (default: 1920)",
+        type=int,
+        default=1920,
+    )
+
+    parser.add_argument(
+        "--height",
+        help="Height of the raw images (default: 1080)",
+        type=int,
+        default=1080,
+    )
+
+    parser.add_argument(
+        "--polygons",
+        help="Number of crocodile polygons per raw image (default: 4)",
+        type=int,
+        default=4,
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of workers passed to the scripts that support them (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "-s", "--seed",
+        help="Seed of the fixtures and of every script (default: 0)",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--repeats",
+        help="Number of times every function is called in the function benchmarks (default: 20)",
+        type=int,
+        default=20,
+    )
+
+    parser.add_argument(
+        "-c", "--compare",
+        help="Results JSON of an earlier run to compare against",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max_slowdown",
+        help="Exit with an error if a stage is this many times slower than in the compared results (e.g. 1.2)",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--keep",
+        help="Keep the fixtures and datasets after the benchmark",
+        action="store_true"
+    )
+
+    args = vars(parser.parse_args())
+
+    args["output"] = os.path.abspath(args["output"])
+    args["results"] = os.path.abspath(args["results"])
+
+    smallest_size = int(min(args["width"], args["height"])*min(create_synthetic_dataset.SCALES))
+
+    if smallest_size < max(create_synthetic_dataset.TARGET_WIDTH, create_synthetic_dataset.TARGET_HEIGHT):
+        print(f"Images of {args['width']}x{args['height']} are too small to be cropped at every scale")
+        exit()
+
+    if args["compare"] is not None and not os.path.exists(args["compare"]):
+        print(f"Results - {args['compare']} - do not exist")
+        exit()
+
+    if os.path.exists(args["output"]):
+        shutil.rmtree(args["output"])
+
+    os.makedirs(args["output"])
+
+    return args
+
+def _create_fixture(directory: str, program_arguments: dict) -> None:
+
+    rng = np.random.default_rng(program_arguments["seed"])
+
+    width = program_arguments["width"]
+    height = program_arguments["height"]
+
+    # Polygons stay small enough to fit in a crop at the largest scale
+    max_extent = int(min(create_synthetic_dataset.TARGET_WIDTH, create_synthetic_dataset.TARGET_HEIGHT)/max(create_synthetic_dataset.SCALES)) // 2
+
+    os.makedirs(directory)
+
+    annotations = {}
+
+    for image_idx in range(program_arguments["images"]):
+
+        # Smoothed noise compresses like a rendered image rather than like pure noise
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        image = cv2.GaussianBlur(image, (7, 7), 2)
+
+        image_filename = f"render_{image_idx}.png"
+        cv2.imwrite(os.path.join(directory, image_filename), image)
+
+        polygons = []
+
+        for _ in range(program_arguments["polygons"]):
+
+            center_x = int(rng.integers(max_extent, width - max_extent))
+            center_y = int(rng.integers(max_extent, height - max_extent))
+            points = int(rng.integers(6, 20))
+
+            x_points = (center_x + rng.integers(-max_extent, max_extent, points)).tolist()
+            y_points = (center_y + rng.integers(-max_extent//2, max_extent//2, points)).tolist()
+
+            polygons.append([x_points, y_points])
+
+        annotations[image_filename] = {"polygons": polygons}
+
+    with open(os.path.join(directory, "annotations.json"), "w") as f:
+        json.dump(annotations, f)
+
+def _directory_size(directory: str) -> tuple:
+
+    size = 0
+    images = 0
+    inodes = set()
+
+    for root, _, filenames in os.walk(directory):
+
+        for filename in filenames:
+
+            stats = os.lstat(os.path.join(root, filename))
+
+            # Links into other datasets are not written data
+            if not os.path.isfile(os.path.join(root, filename)) or os.path.islink(os.path.join(root, filename)) or (stats.st_dev, stats.st_ino) in inodes:
+                continue
+
+            inodes.add((stats.st_dev, stats.st_ino))
+            size += stats.st_size
+
+            if os.path.splitext(filename)[1] in [".png", ".jpg", ".webp"]:
+                images += 1
+
+    return size, images
+
+def _run_stage(name: str, command: list, output: str, log_directory: str) -> dict:
+
+    print(f"Running - {name}")
+
+    with open(os.path.join(log_directory, f"{name}.log"), "w") as log:
+
+        start = time.perf_counter()
+
+        process = subprocess.Popen([sys.executable] + command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        # wait4 reports the resources of the stage and the worker processes it waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        seconds = time.perf_counter() - start
+
+    size, images = _directory_size(output)
+
+    if process.returncode != 0:
+        print(f"Stage - {name} - failed with exit code {process.returncode}, see {log.name}")
+
+    return {
+        "command": command,
+        "returncode": process.returncode,
+        "seconds": seconds,
+        "images": images,
+        "images_per_second": images/seconds,
+        "bytes_written": size,
+        "mb_per_second": size/2**20/seconds,
+        "peak_rss_mb": usage.ru_maxrss/1024,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+    }
+
+def _profile_saved(filename: str) -> bool:
+
+    try:
+        with open(filename, "r") as f:
+            json.load(f)
+    except (OSError, ValueError):
+        print(f"Profile - {filename} - was not saved")
+        return False
+
+    return True
+
+def _time_function(function, repeats: int) -> dict:
+
+    function()
+
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        function()
+
+    seconds = (time.perf_counter() - start)/repeats
+
+    return {"calls": repeats, "milliseconds_per_call": seconds*1000}
+
+def _benchmark_functions(raw_directory: str, program_arguments: dict) -> dict:
+
+    with open(os.path.join(raw_directory, "annotations.json"), "r") as f:
+        annotations = json.load(f)
+
+    image_filename = sorted(annotations.keys())[0]
+    image = cv2.imread(os.path.join(raw_directory, image_filename))
+
+    polygons = annotations[image_filename]["polygons"]
+    points = np.array([[x, y] for xs, ys in polygons for x, y in zip(xs, ys)], dtype=np.int32)
+    offsets = np.cumsum([0] + [len(xs) for xs, _ in polygons])
+
+    target_size = (create_synthetic_dataset.TARGET_WIDTH, create_synthetic_dataset.TARGET_HEIGHT)
+    scale = create_synthetic_dataset.SCALES[-1]
+
+    scaled_size = create_synthetic_dataset._scaled_size(image, scale)
+    boxes = _scale_boxes(_boxes_around_polygon_points(points, offsets), scale)
+    crops = create_synthetic_dataset._sample_crops(boxes, scaled_size, random.Random(program_arguments["seed"]))
+    crop = _resize_window(image, scaled_size, crops[0].tolist())
+
+    free_space = _crop_free_space(boxes, scaled_size, target_size)
+    rng = np.random.default_rng(program_arguments["seed"])
+
+    functions = {
+        "cv2.imread": lambda: cv2.imread(os.path.join(raw_directory, image_filename)),
+        "_boxes_around_polygon_points": lambda: _boxes_around_polygon_points(points, offsets),
+        "_sample_crops": lambda: create_synthetic_dataset._sample_crops(boxes, scaled_size, random.Random(0)),
+        "_plan_cover_crops": lambda: _plan_cover_crops(boxes, scaled_size, target_size, 2, random.Random(0)),
+        "_generate_YOLO_annotations_for_crops": lambda: _generate_YOLO_annotations_for_crops(boxes, crops, list(target_size)),
+        "_crop_free_space": lambda: _crop_free_space(boxes, scaled_size, target_size),
+        "_sample_free_crops": lambda: _sample_free_crops(free_space, target_size, len(boxes), random.Random(0)),
+        "_resize_window": lambda: _resize_window(image, scaled_size, crops[0].tolist()),
+        "_resize_windows": lambda: _resize_windows(image, scaled_size, crops.tolist()),
+        "_encode_image(png)": lambda: _encode_image(crop, "png"),
+        "_encode_image(jpg)": lambda: _encode_image(crop, "jpg"),
+        "_add_gaussian_blur": lambda: _add_gaussian_blur(crop, 1.0),
+        "_add_gaussian_noise": lambda: _add_gaussian_noise(crop, 5.0, rng),
+    }
+
+    results = {}
+
+    for name, function in functions.items():
+        results[name] = _time_function(function, program_arguments["repeats"])
+
+    return results
+
+def _compare_results(results: dict, baseline: dict, max_slowdown: float) -> bool:
+
+    regressed = False
+
+    print(f"{'':<36}{'baseline':>10}{'current':>10}{'ratio':>10}")
+
+    for name, stage in results["stages"].items():
+
+        if name not in baseline["stages"]:
+            continue
+
+        ratio = stage["seconds"]/baseline["stages"][name]["seconds"]
+        print(f"{name:<36}{baseline['stages'][name]['seconds']:>10.2f}{stage['seconds']:>10.2f}{ratio:>10.2f}")
+
+        if max_slowdown is not None and ratio > max_slowdown:
+            regressed = True
+
+    for name, function in results["functions"].items():
+
+        if name not in baseline["functions"]:
+            continue
+
+        ratio = function["milliseconds_per_call"]/baseline["functions"][name]["milliseconds_per_call"]
+        print(f"{name:<36}{baseline['functions'][name]['milliseconds_per_call']:>10.3f}{function['milliseconds_per_call']:>10.3f}{ratio:>10.2f}")
+
+    return regressed
+
+def main():
+
+    program_arguments = _parse_arguments()
+
+    output = program_arguments["output"]
+    workers = str(program_arguments["workers"])
+    seed = str(program_arguments["seed"])
+
+    raw_directory = os.path.join(output, "raw_synthetic_data")
+    log_directory = os.path.join(output, "logs")
+    os.makedirs(log_directory)
+
+    # The cover planner run also checks that its profile can be saved
+    cover_profile = os.path.join(log_directory, "cover_profile.json")
+
+    print(f"Creating fixture of {program_arguments['images']} images")
+    _create_fixture(raw_directory, program_arguments)
+
+    synthetic = os.path.join(output, "synthetic_dataset")
+    covered = os.path.join(output, "covered_dataset")
+    downsampled = os.path.join(output, "downsampled_dataset")
+    merged = os.path.join(output, "merged_dataset")
+    augmented = os.path.join(output, "augmented_dataset")
+
+    stages = [
+        ("1_create_synthetic_dataset", ["1_create_synthetic_dataset.py", "-i", raw_directory, "-o", synthetic, "-n", "-s", seed, "-w", workers], synthetic),
+        ("1_create_synthetic_dataset_cover", ["1_create_synthetic_dataset.py", "-i", raw_directory, "-o", covered, "-n", "-s", seed, "-w", workers, "--planner", "cover", "--profile", cover_profile], covered),
+        ("2_downsample_dataset", ["2_downsample_dataset.py", "-i", synthetic, "-o", downsampled, "-p", "50"], downsampled),
+        ("3_merge_synthetic_and_real_dataset", ["3_merge_synthetic_and_real_dataset.py", "-a", synthetic, "-b", downsampled, "-o", merged], merged),
+        ("4_augment_dataset", ["4_augment_dataset.py", "-i", synthetic, "-o", augmented, "-b", "1", "-n", "5", "-s", seed, "-w", workers], augmented),
+    ]
+
+    results = {
+        "settings": {name: program_arguments[name] for name in ["images", "width", "height", "polygons", "workers", "seed", "repeats"]},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": {},
+        "functions": {},
+    }
+
+    for name, command, stage_output in stages:
+        results["stages"][name] = _run_stage(name, command, stage_output, log_directory)
+
+    profiled = _profile_saved(cover_profile)
+
+    print("Benchmarking functions")
+    results["functions"] = _benchmark_functions(raw_directory, program_arguments)
+
+    print(f"{'':<36}{'seconds':>10}{'images/s':>10}{'MB/s':>10}{'peak MB':>10}")
+
+    for name, stage in results["stages"].items():
+        print(f"{name:<36}{stage['seconds']:>10.2f}{stage['images_per_second']:>10.1f}{stage['mb_per_second']:>10.1f}{stage['peak_rss_mb']:>10.1f}")
+
+    for name, function in results["functions"].items():
+        print(f"{name:<36}{function['milliseconds_per_call']:>10.3f} ms")
+
+    with open(program_arguments["results"], "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Results saved to - {program_arguments['results']}")
+
+    if not program_arguments["keep"]:
+        shutil.rmtree(output)
+
+    failed = not profiled or any(stage["returncode"] != 0 for stage in results["stages"].values())
+
+    if program_arguments["compare"] is not None:
+
+        with open(program_arguments["compare"], "r") as f:
+            baseline = json.load(f)
+
+        if _compare_results(results, baseline, program_arguments["max_slowdown"]):
+            print(f"At least one stage is more than {program_arguments['max_slowdown']} times slower than in - {program_arguments['compare']}")
+            failed = True
+
+    if failed:
+        exit(1)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,219 @@
+import os, csv, argparse
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+import cv2
+
+from _utils import _create_YOLO_directory, _add_dataset_format_arguments, _add_dataset_view_arguments, _DatasetReader, _DatasetWriter, _open_dataset_reader, _report_failed_writes, _add_profile_arguments, _enable_profiler, _report_profile, PROFILER
+
+HASH_SIZE = 8
+HASH_CHUNK = 256
+
+def _parse_arguments():
+
+    parser = argparse.ArgumentParser("Deduplicate Dataset")
+
+    parser.add_argument(
+        "-i", "--input",
+        help="Directory of dataset to remove near-duplicate training images from (default: synthetic_dataset)",
+        default="synthetic_dataset"
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="Directory where dataset should be stored (default: deduplicated_dataset)",
+        default="deduplicated_dataset"
+    )
+
+    parser.add_argument(
+        "-t", "--threshold",
+        help=f"Largest number of differing bits (of {HASH_SIZE*HASH_SIZE}) between the hashes of two near-duplicate images (default: 6)",
+        type=int,
+        default=6,
+    )
+
+    parser.add_argument(
+        "-k", "--keep",
+        help="Number of images kept of every group of near-duplicates (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes used to hash the images (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    _add_dataset_format_arguments(parser)
+    _add_dataset_view_arguments(parser)
+    _add_profile_arguments(parser)
+
+    args = vars(parser.parse_args())
+
+    _enable_profiler(args)
+
+    args["input"] = os.path.abspath(args["input"])
+    args["output"] = os.path.abspath(args["output"])
+    args["workers"] = max(1, args["workers"])
+
+    if not os.path.exists(args["input"]) :
+        print(f"Input directory - {args['input']} - does not exist")
+        exit()
+
+    if not 0 <= args["threshold"] < HASH_SIZE*HASH_SIZE:
+        print(f"Threshold - {args['threshold']} - should be between 0 and {HASH_SIZE*HASH_SIZE - 1}")
+        exit()
+
+    if args["keep"] < 1:
+        print("At least one image of every group has to be kept")
+        exit()
+
+    _create_YOLO_directory(args["output"], args["output_format"], view=args["view"])
+
+    return args
+
+def _difference_hash(img: np.ndarray) -> int:
+
+    # Every bit tells whether a pixel of the shrunken image is brighter than its right neighbour
+    small = cv2.resize(img, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).reshape(-1)
+
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def _hash_images(indices: range, program_arguments: dict) -> tuple:
+
+    reader = _open_dataset_reader(program_arguments["input"], "train")
+
+    hashes = []
+
+    for idx in indices:
+
+        content = reader.read_bytes(idx)
+
+        # Only a small grayscale version is needed, which most decoders produce faster than the full image
+        with PROFILER.span("decode"):
+            img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+
+        if img is None:
+            print(f"Could not decode - {reader.filenames[idx]}, it is kept")
+            hashes.append(None)
+            continue
+
+        with PROFILER.span("hash"):
+            hashes.append(_difference_hash(img))
+
+    PROFILER.count("images hashed", len(indices))
+
+    return hashes, PROFILER.collect()
+
+def _hash_bands(threshold: int) -> list:
+
+    # Hashes that differ in at most threshold bits agree on at least one of threshold + 1 bands
+    bands = threshold + 1
+    edges = [HASH_SIZE*HASH_SIZE*band//bands for band in range(bands + 1)]
+
+    return [(start, (1 << (stop - start)) - 1) for start, stop in zip(edges[:-1], edges[1:])]
+
+def _select_images(hashes: list, threshold: int, keep: int) -> list:
+
+    bands = _hash_bands(threshold)
+    buckets = [{} for _ in bands]
+
+    kept_hashes = {}
+    duplicates = []
+
+    for idx, image_hash in enumerate(hashes):
+
+        if image_hash is None:
+            continue
+
+        candidates = set()
+
+        for bucket, (shift, mask) in zip(buckets, bands):
+            candidates.update(bucket.get((image_hash >> shift) & mask, ()))
+
+        PROFILER.count("hash comparisons", len(candidates))
+
+        near = sorted((bin(image_hash ^ kept_hashes[candidate]).count("1"), candidate) for candidate in candidates)
+        near = [(distance, candidate) for distance, candidate in near if distance <= threshold]
+
+        # Images are kept in dataset order until a group of near-duplicates is full
+        if len(near) >= keep:
+            duplicates.append((idx, near[0][1], near[0][0]))
+            continue
+
+        kept_hashes[idx] = image_hash
+
+        for bucket, (shift, mask) in zip(buckets, bands):
+            bucket.setdefault((image_hash >> shift) & mask, []).append(idx)
+
+    return duplicates
+
+def _write_duplicates(filename: str, reader: _DatasetReader, duplicates: list) -> None:
+
+    with open(filename, "w", newline="") as f:
+
+        writer = csv.writer(f)
+        writer.writerow(["image", "duplicate_of", "distance"])
+
+        for idx, kept_idx, distance in duplicates:
+            writer.writerow([reader.filenames[idx], reader.filenames[kept_idx], distance])
+
+def main():
+
+    program_arguments = _parse_arguments()
+
+    val_reader = _DatasetReader(program_arguments["input"], "val")
+    val_writer = _DatasetWriter(program_arguments["output"], "val", program_arguments)
+
+    for idx in range(len(val_reader)):
+        val_writer.add_from(val_reader, idx)
+
+    train_reader = _DatasetReader(program_arguments["input"], "train")
+
+    chunks = [range(start, min(start + HASH_CHUNK, len(train_reader))) for start in range(0, len(train_reader), HASH_CHUNK)]
+    hash_images = partial(_hash_images, program_arguments=program_arguments)
+
+    pool = None
+
+    if program_arguments["workers"] == 1:
+        results = map(hash_images, chunks)
+
+    else:
+        pool = Pool(program_arguments["workers"], initializer=cv2.setNumThreads, initargs=(1,))
+        results = pool.imap(hash_images, chunks)
+
+    hashes = []
+
+    for chunk_hashes, profile in results:
+        PROFILER.merge(profile)
+        hashes += chunk_hashes
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    with PROFILER.span("duplicate search"):
+        duplicates = _select_images(hashes, program_arguments["threshold"], program_arguments["keep"])
+
+    dropped = set(idx for idx, _, _ in duplicates)
+
+    train_writer = _DatasetWriter(program_arguments["output"], "train", program_arguments)
+
+    for idx in range(len(train_reader)):
+        if idx not in dropped:
+            train_writer.add_from(train_reader, idx)
+
+    failures = val_writer.close() + train_writer.close()
+
+    _write_duplicates(os.path.join(program_arguments["output"], "duplicates.csv"), train_reader, duplicates)
+
+    print(f"Removed {len(duplicates)} of {len(train_reader)} training images as near-duplicates, see {os.path.join(program_arguments['output'], 'duplicates.csv')}")
+
+    _report_profile(program_arguments)
+    _report_failed_writes(failures)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,349 @@
+import argparse, os, json, math, string, random, threading, importlib
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+import cv2
+
+from _utils import (
+    _load_annotation_index,
+    _open_annotation_index,
+    _image_polygon_points,
+    _boxes_around_polygon_points,
+    _create_YOLO_directory,
+    _add_writer_arguments,
+    _add_dataset_format_arguments,
+    _add_dataset_view_arguments,
+    _encode_image,
+    _DatasetReader,
+    _DatasetWriter,
+    _open_dataset_reader,
+    _report_failed_writes,
+    _open_raw_data,
+    _render_tasks,
+    _image_seed,
+    _add_gaussian_blur,
+    _add_gaussian_noise,
+    _add_profile_arguments,
+    _enable_profiler,
+    _report_profile,
+    PROFILER,
+    IMAGE_FORMATS,
+)
+
+# The crops are planned and cut by the same code as 1_create_synthetic_dataset.py
+create_synthetic_dataset = importlib.import_module("1_create_synthetic_dataset")
+
+SYNTHETIC_DEFAULTS = {
+    "negative": False,
+    "negatives": None,
+    "planner": "random",
+    "max_appearances": 2,
+}
+
+def _parse_arguments() -> dict:
+
+    parser = argparse.ArgumentParser("Run Pipeline")
+
+    parser.add_argument(
+        "-p", "--pipeline",
+        help="JSON file describing the synthetic source, the sample percentage, the datasets merged in and the augmentation",
+        required=True,
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="Directory where the final dataset should be stored (default: pipeline_dataset)",
+        default="pipeline_dataset"
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of processes used to crop and augment the images (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "-s", "--seed",
+        help="Master seed from which the crops, the selection and the noise of every image are derived (default: random)",
+        type=int,
+        default=None,
+    )
+
+    _add_writer_arguments(parser)
+    _add_dataset_format_arguments(parser)
+    _add_dataset_view_arguments(parser)
+    _add_profile_arguments(parser)
+
+    args = vars(parser.parse_args())
+
+    _enable_profiler(args)
+
+    args["output"] = os.path.abspath(args["output"])
+    args["workers"] = max(1, args["workers"])
+
+    if not os.path.exists(args["pipeline"]):
+        print(f"Pipeline - {args['pipeline']} - does not exist")
+        exit()
+
+    args.update(_load_pipeline(args["pipeline"]))
+
+    if args["seed"] is None:
+        args["seed"] = random.SystemRandom().randrange(2**32)
+        print(f"Using seed - {args['seed']}")
+
+    _create_YOLO_directory(args["output"], args["output_format"], view=args["view"])
+
+    return args
+
+def _load_pipeline(filename: str) -> dict:
+
+    with open(filename, "r") as f:
+        pipeline = json.load(f)
+
+    # Relative paths in the pipeline file are relative to the file itself
+    base = os.path.dirname(os.path.abspath(filename))
+
+    synthetic = dict(SYNTHETIC_DEFAULTS)
+    synthetic.update(pipeline.get("synthetic", {}))
+
+    if "input" not in synthetic:
+        print("Pipeline has no synthetic input")
+        exit()
+
+    synthetic["input"] = os.path.join(base, synthetic["input"])
+    synthetic["max_appearances"] = max(1, synthetic["max_appearances"])
+
+    if not os.path.exists(synthetic["input"]):
+        print(f"Input directory - {synthetic['input']} - does not exist")
+        exit()
+
+    if synthetic["planner"] not in create_synthetic_dataset.PLANNERS:
+        print(f"Planner - {synthetic['planner']} - should be one of {', '.join(create_synthetic_dataset.PLANNERS)}")
+        exit()
+
+    percentage = float(pipeline.get("percentage", 100))
+
+    if not 0 <= percentage <= 100:
+        print(f"Percentage - {percentage:g} - should be between 0 and 100")
+        exit()
+
+    merge = [os.path.join(base, directory) for directory in pipeline.get("merge", [])]
+
+    for directory in merge:
+        if not os.path.exists(directory):
+            print(f"Dataset - {directory} - does not exist")
+            exit()
+
+    if len(merge) > len(string.ascii_lowercase) - 1:
+        print(f"At most {len(string.ascii_lowercase)} datasets can be merged")
+        exit()
+
+    augment = {"blurring": 0, "noise": 0}
+    augment.update(pipeline.get("augment", {}))
+
+    return {"synthetic": synthetic, "percentage": percentage, "merge": merge, "augment": augment}
+
+def _evenly_kept(percentage: float, offset: float):
+
+    fraction = percentage/100
+
+    # Keeps every crop at which the running share of the percentage passes a whole number, like the evenly spaced selection of 2_downsample_dataset.py
+    return lambda idx: math.floor((idx + 1)*fraction + offset) > math.floor(idx*fraction + offset)
+
+def _merged_filename(filename: str, prefix: str) -> str:
+
+    return filename if prefix is None else f"{prefix}_{filename}"
+
+def _augment(img: np.ndarray, filename: str, program_arguments: dict) -> np.ndarray:
+
+    augment = program_arguments["augment"]
+
+    if augment["blurring"] != 0:
+        with PROFILER.span("blur"):
+            img = _add_gaussian_blur(img, augment["blurring"])
+
+    if augment["noise"] != 0:
+        with PROFILER.span("noise"):
+            img = _add_gaussian_noise(img, augment["noise"], np.random.default_rng(_image_seed(program_arguments["seed"], filename)))
+
+    return img
+
+def _crop_samples(image_idx: int, image_filename: str, content: bytes, program_arguments: dict):
+
+    raw_data = _open_raw_data(program_arguments["synthetic"]["input"])
+
+    if content is None and not raw_data.exists(image_filename):
+        print(f"Image - {raw_data.path(image_filename)} - was not found")
+        return
+
+    with PROFILER.span("annotations"):
+        annotation_index = _open_annotation_index(program_arguments["annotation_index"])
+        points, offsets = _image_polygon_points(annotation_index, image_idx)
+        boxes = _boxes_around_polygon_points(points, offsets)
+
+    print(f"Processing - {raw_data.path(image_filename)}")
+
+    img = raw_data.read_image(image_filename, content)
+
+    if img is None:
+        print(f"Image - {raw_data.path(image_filename)} - could not be read")
+        return
+
+    PROFILER.count("images read")
+
+    rng = random.Random(_image_seed(program_arguments["seed"], image_filename))
+
+    # Every image starts the selection at its own offset so the share of small images does not round down to nothing
+    offset = random.Random(_image_seed(program_arguments["seed"], f"select/{image_filename}")).random()
+    keep = None if program_arguments["percentage"] == 100 else _evenly_kept(program_arguments["percentage"], offset)
+
+    for save_filename, cropped_image, image_annotations, scale in create_synthetic_dataset._generate_samples(img, boxes, image_filename, rng, program_arguments["synthetic"], keep):
+        yield save_filename + IMAGE_FORMATS[program_arguments["image_format"]], cropped_image, image_annotations, {"source": image_filename, "scale": scale}
+
+def _merge_samples(samples, prefix: str):
+
+    for filename, img, annotations, metadata in samples:
+        yield _merged_filename(filename, prefix), img, annotations, metadata
+
+def _augment_samples(samples, program_arguments: dict):
+
+    for filename, img, annotations, metadata in samples:
+        yield filename, _augment(img, filename, program_arguments), annotations, metadata
+
+def _encode_samples(samples, program_arguments: dict) -> list:
+
+    encoded = []
+
+    for filename, img, annotations, metadata in samples:
+
+        with PROFILER.span("encode"):
+            content = _encode_image(img, program_arguments["image_format"], program_arguments["png_compression"], program_arguments["quality"])
+
+        encoded.append((filename, content, annotations, img.shape[:2], metadata))
+
+    return encoded
+
+def _process_render(task: tuple, program_arguments: dict) -> tuple:
+
+    image_idx, image_filename, content = task
+
+    _enable_profiler(program_arguments)
+
+    # Crops only exist as arrays between the stages, and only the selected ones are ever resized
+    samples = _crop_samples(image_idx, image_filename, content, program_arguments)
+    samples = _merge_samples(samples, "a" if len(program_arguments["merge"]) > 0 else None)
+    samples = _augment_samples(samples, program_arguments)
+
+    return _encode_samples(samples, program_arguments), PROFILER.collect()
+
+def _process_merged_image(task: tuple, program_arguments: dict) -> tuple:
+
+    directory, idx, filename = task
+
+    _enable_profiler(program_arguments)
+
+    reader = _open_dataset_reader(directory, "train")
+
+    img = reader.read_image(idx, cv2.IMREAD_UNCHANGED)
+
+    if img is None:
+        print(f"Image - {reader.image_path(idx)} - could not be read")
+        return [], PROFILER.collect()
+
+    output_filename = os.path.splitext(filename)[0] + IMAGE_FORMATS[program_arguments["image_format"]]
+    samples = _augment_samples([(filename, img, reader.read_annotations(idx), reader.metadata(idx))], program_arguments)
+
+    # The noise is seeded with the merged filename, the output may be re-encoded in another format
+    return [(output_filename, content, annotations, shape, metadata) for _, content, annotations, shape, metadata in _encode_samples(samples, program_arguments)], PROFILER.collect()
+
+def main():
+
+    program_arguments = _parse_arguments()
+
+    raw_data = _open_raw_data(program_arguments["synthetic"]["input"])
+
+    with PROFILER.span("annotation index"):
+        program_arguments["annotation_index"] = _load_annotation_index(raw_data, program_arguments["output"])
+
+    image_filenames = _open_annotation_index(program_arguments["annotation_index"])["filenames"]
+
+    augmented = program_arguments["augment"]["blurring"] != 0 or program_arguments["augment"]["noise"] != 0
+    prefixes = string.ascii_lowercase[1:]
+
+    train_writer = _DatasetWriter(program_arguments["output"], "train", program_arguments)
+    val_writer = _DatasetWriter(program_arguments["output"], "val", program_arguments)
+
+    in_flight = threading.BoundedSemaphore(2*program_arguments["workers"])
+
+    process_render = partial(_process_render, program_arguments=program_arguments)
+    process_merged_image = partial(_process_merged_image, program_arguments=program_arguments)
+
+    pool = None
+    image_map = map
+
+    if program_arguments["workers"] > 1:
+        pool = Pool(program_arguments["workers"], initializer=cv2.setNumThreads, initargs=(1,))
+        image_map = pool.imap
+
+    crops = 0
+
+    for encoded, profile in image_map(process_render, _render_tasks(raw_data, image_filenames, in_flight)):
+
+        if not raw_data.random_access:
+            in_flight.release()
+
+        PROFILER.merge(profile)
+
+        for filename, content, annotations, shape, metadata in encoded:
+            train_writer.add_bytes(filename, content, annotations, shape, metadata)
+
+        crops += len(encoded)
+
+    merged = 0
+
+    for directory, prefix in zip(program_arguments["merge"], prefixes):
+
+        reader = _DatasetReader(directory, "train")
+
+        # Without augmentation the merged images are taken over as they are, like 3_merge_synthetic_and_real_dataset.py does
+        if not augmented:
+
+            for idx in range(len(reader)):
+                train_writer.add_from(reader, idx, _merged_filename(reader.filenames[idx], prefix))
+
+            merged += len(reader)
+            continue
+
+        tasks = [(directory, idx, _merged_filename(reader.filenames[idx], prefix)) for idx in range(len(reader))]
+
+        for encoded, profile in image_map(process_merged_image, tasks):
+
+            PROFILER.merge(profile)
+
+            for filename, content, annotations, shape, metadata in encoded:
+                train_writer.add_bytes(filename, content, annotations, shape, metadata)
+
+            merged += len(encoded)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # Validation images are never augmented, so they are only merged
+    for directory, prefix in zip(program_arguments["merge"], prefixes):
+
+        reader = _DatasetReader(directory, "val")
+
+        for idx in range(len(reader)):
+            val_writer.add_from(reader, idx, _merged_filename(reader.filenames[idx], prefix))
+
+    failures = train_writer.close() + val_writer.close()
+
+    print(f"Wrote {crops} synthetic crops and {merged} merged training images to - {program_arguments['output']}")
+
+    _report_profile(program_arguments)
+    _report_failed_writes(failures)
+
+if __name__ == "__main__" :
+    main()
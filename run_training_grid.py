@@ -0,0 +1,254 @@
+import argparse, os, sys, csv, json, queue, shutil, hashlib, itertools, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from _utils import _print_table
+
+TRAIN_SCRIPT = "5_train_YOLO_network.py"
+METRICS = ["metrics/precision(B)", "metrics/recall(B)", "metrics/mAP50(B)", "metrics/mAP50-95(B)"]
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+
+def _parse_arguments() -> dict:
+
+    parser = argparse.ArgumentParser("Run Training Grid")
+
+    parser.add_argument(
+        "-g", "--grid",
+        help="JSON file describing the grid of trainings",
+        required=True,
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="Directory where every training and the results table are stored (default: training_grid)",
+        default="training_grid"
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        help="Number of trainings that run at the same time (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--cpus_per_job",
+        help="Pin every training to its own set of this many CPUs (default: no pinning)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--threads_per_job",
+        help="Number of compute threads of every training (default: --cpus_per_job if given, otherwise unlimited)",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--dry_run",
+        help="Only list the trainings that would run",
+        action="store_true"
+    )
+
+    args = vars(parser.parse_args())
+
+    args["output"] = os.path.abspath(args["output"])
+    args["jobs"] = max(1, args["jobs"])
+
+    if args["threads_per_job"] is None:
+        args["threads_per_job"] = args["cpus_per_job"]
+
+    if not os.path.exists(args["grid"]):
+        print(f"Grid - {args['grid']} - does not exist")
+        exit()
+
+    if args["cpus_per_job"] is not None:
+
+        if not hasattr(os, "sched_getaffinity") or shutil.which("taskset") is None:
+            print("Pinning trainings to CPUs needs taskset, which is not available on this platform")
+            exit()
+
+        if args["cpus_per_job"]*args["jobs"] > len(os.sched_getaffinity(0)):
+            print(f"{args['jobs']} jobs of {args['cpus_per_job']} CPUs need more than the {len(os.sched_getaffinity(0))} available CPUs")
+            exit()
+
+    os.makedirs(args["output"], exist_ok=True)
+
+    return args
+
+def _load_configurations(filename: str) -> list:
+
+    with open(filename, "r") as f:
+        grid = json.load(f)
+
+    base = grid.get("base", {})
+    axes = grid.get("grid", {})
+
+    for name, values in axes.items():
+        if not isinstance(values, list):
+            print(f"Grid values of - {name} - should be a list")
+            exit()
+
+    configurations = []
+
+    for values in itertools.product(*axes.values()):
+
+        configuration = dict(base)
+        configuration.update(zip(axes.keys(), values))
+
+        if "dataset" not in configuration:
+            print(f"Configuration - {configuration} - has no dataset")
+            exit()
+
+        configuration["dataset"] = os.path.abspath(configuration["dataset"])
+        configurations.append(configuration)
+
+    return configurations
+
+def _configuration_hash(configuration: dict) -> str:
+
+    return hashlib.sha256(json.dumps(configuration, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def _training_command(configuration: dict, output: str) -> list:
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), TRAIN_SCRIPT), "--output", output]
+
+    for name, value in configuration.items():
+
+        if value is True:
+            command.append(f"--{name}")
+
+        elif value is not False and value is not None:
+            command += [f"--{name}", str(value)]
+
+    return command
+
+def _run_training(configuration: dict, directory: str, program_arguments: dict, cpu_sets: queue.Queue) -> int:
+
+    cpus = cpu_sets.get()
+
+    try:
+
+        environment = dict(os.environ)
+
+        if program_arguments["threads_per_job"] is not None:
+            for variable in THREAD_VARIABLES:
+                environment[variable] = str(program_arguments["threads_per_job"])
+
+        print(f"Starting - {os.path.basename(directory)}")
+
+        with open(os.path.join(directory, "train.log"), "w") as log:
+
+            command = _training_command(configuration, directory)
+
+            # taskset pins the training before it starts, so every thread and process it creates inherits the CPUs
+            if cpus is not None:
+                command = ["taskset", "--cpu-list", ",".join(str(cpu) for cpu in cpus)] + command
+
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=environment)
+
+            returncode = process.wait()
+
+        if returncode != 0:
+            print(f"Failed - {os.path.basename(directory)} - exit code {returncode}, see {log.name}")
+        else:
+            print(f"Finished - {os.path.basename(directory)}")
+
+        return returncode
+
+    finally:
+        cpu_sets.put(cpus)
+
+def _write_results_table(configurations: list, directories: list, filename: str) -> None:
+
+    # An argument that only some configurations give still varies, it is missing from the others
+    names = dict.fromkeys(name for configuration in configurations for name in configuration)
+    varying = [name for name in names if len(set(json.dumps(configuration.get(name)) for configuration in configurations)) > 1]
+
+    rows = []
+
+    for configuration, directory in zip(configurations, directories):
+
+        row = {"hash": os.path.basename(directory)}
+        row.update({name: configuration.get(name) for name in varying})
+
+        results_filename = os.path.join(directory, "results.json")
+
+        if os.path.exists(results_filename):
+
+            with open(results_filename, "r") as f:
+                metrics = json.load(f)["metrics"]
+
+            row.update({name: metrics.get(name) for name in METRICS})
+
+        rows.append(row)
+
+    columns = ["hash"] + varying + METRICS
+
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    _print_table(rows, columns)
+
+    print(f"Results saved to - {filename}")
+
+def main():
+
+    program_arguments = _parse_arguments()
+
+    configurations = _load_configurations(program_arguments["grid"])
+
+    directories = [os.path.join(program_arguments["output"], _configuration_hash(configuration)) for configuration in configurations]
+
+    pending = []
+
+    for configuration, directory in zip(configurations, directories):
+
+        # A training is finished once its results exist, so a crashed grid resumes where it stopped
+        if os.path.exists(os.path.join(directory, "results.json")):
+            continue
+
+        pending.append((configuration, directory))
+
+    print(f"{len(configurations)} trainings in the grid, {len(configurations) - len(pending)} already finished")
+
+    for configuration, directory in pending:
+        print(f"{os.path.basename(directory)} - {json.dumps(configuration, sort_keys=True)}")
+
+    if program_arguments["dry_run"]:
+        return
+
+    cpu_sets = queue.Queue()
+    available_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+
+    for job in range(program_arguments["jobs"]):
+
+        cpus = None
+
+        if program_arguments["cpus_per_job"] is not None:
+            cpus = available_cpus[job*program_arguments["cpus_per_job"]:(job + 1)*program_arguments["cpus_per_job"]]
+
+        cpu_sets.put(cpus)
+
+    for configuration, directory in pending:
+
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, "configuration.json"), "w") as f:
+            json.dump(configuration, f, indent=2, sort_keys=True)
+
+    with ThreadPoolExecutor(max_workers=program_arguments["jobs"]) as executor:
+        returncodes = list(executor.map(lambda job: _run_training(job[0], job[1], program_arguments, cpu_sets), pending))
+
+    _write_results_table(configurations, directories, os.path.join(program_arguments["output"], "results.csv"))
+
+    failed = sum(returncode != 0 for returncode in returncodes)
+
+    if failed > 0:
+        print(f"{failed} trainings failed, run the grid again to retry them")
+        exit(1)
+
+if __name__ == "__main__" :
+    main()
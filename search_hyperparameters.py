@@ -0,0 +1,371 @@
+import argparse, os, sys, csv, json, random, importlib, subprocess
+import multiprocessing
+import optuna
+
+from _utils import DATASET_VIEWS, _format_value
+from run_training_grid import _configuration_hash
+
+# Trials train in the search process itself so every validated epoch can be reported to the study
+train_YOLO_network = importlib.import_module("5_train_YOLO_network")
+
+DOWNSAMPLE_SCRIPT = "2_downsample_dataset.py"
+MERGE_SCRIPT = "3_merge_synthetic_and_real_dataset.py"
+METRIC = "metrics/mAP50(B)"
+FINISHED_STATES = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED, optuna.trial.TrialState.FAIL)
+
+SEARCH_SPACE = {
+    "model": {"choices": ["yolov8n.pt", "yolov8s.pt", "yolov8m.pt"]},
+    "freeze": {"choices": [False, True]},
+    "epochs": {"low": 20, "high": 200, "step": 10},
+    "patience": {"low": 10, "high": 50, "step": 5},
+    "percentage": {"low": 5, "high": 100, "step": 5},
+    "blurring": {"low": 0.0, "high": 3.0},
+    "noise": {"low": 0.0, "high": 20.0},
+}
+
+# Defaults of 5_train_YOLO_network.py for everything that is not searched
+TRAINING_DEFAULTS = {
+    "model": "yolov8m.pt",
+    "freeze": False,
+    "epochs": 500,
+    "patience": 40,
+    "blurring": 0,
+    "noise": 0,
+    "random_sigma": False,
+}
+
+def _parse_arguments() -> dict:
+
+    parser = argparse.ArgumentParser("Search Hyperparameters")
+
+    parser.add_argument(
+        "-s", "--synthetic",
+        help="Directory of the synthetic dataset that is downsampled for every trial (default: synthetic_dataset)",
+        default="synthetic_dataset"
+    )
+
+    parser.add_argument(
+        "-r", "--real",
+        help="Directory of the real dataset merged into every trial's dataset (default: real_world_dataset)",
+        default="real_world_dataset"
+    )
+
+    parser.add_argument(
+        "-o", "--output",
+        help="Directory where the study, the dataset variants and every trial are stored (default: hyperparameter_search)",
+        default="hyperparameter_search"
+    )
+
+    parser.add_argument(
+        "--space",
+        help="JSON file that replaces or fixes parameters of the default search space",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--study",
+        help="Name of the study, running the search again with the same name continues it (default: search)",
+        default="search"
+    )
+
+    parser.add_argument(
+        "-t", "--trials",
+        help="Total number of trials of the study (default: 50)",
+        type=int,
+        default=50,
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        help="Number of trials that run at the same time (default: 1)",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--devices",
+        help="Devices the parallel trials are spread over, e.g. 0 1 or cpu (default: first available GPU, otherwise cpu)",
+        nargs="+",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--batch",
+        help="Batch size of every trial (default: 16)",
+        type=int,
+        default=16,
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="Number of dataloader worker processes of every trial (default: 8)",
+        type=int,
+        default=8,
+    )
+
+    parser.add_argument(
+        "--startup_trials",
+        help="Number of trials that finish before any trial is pruned (default: 5)",
+        type=int,
+        default=5,
+    )
+
+    parser.add_argument(
+        "--warmup_epochs",
+        help="Number of epochs every trial trains before it can be pruned (default: 10)",
+        type=int,
+        default=10,
+    )
+
+    parser.add_argument(
+        "--view",
+        help="How the dataset variants refer to the images of the input datasets (default: filelist)",
+        choices=DATASET_VIEWS,
+        default="filelist",
+    )
+
+    parser.add_argument(
+        "--seed",
+        help="Seed of the sampler and the training augmentation (default: random)",
+        type=int,
+        default=None,
+    )
+
+    args = vars(parser.parse_args())
+
+    args["synthetic"] = os.path.abspath(args["synthetic"])
+    args["real"] = os.path.abspath(args["real"])
+    args["output"] = os.path.abspath(args["output"])
+    args["jobs"] = max(1, args["jobs"])
+
+    for dataset in [args["synthetic"], args["real"]]:
+        if not os.path.exists(os.path.join(dataset, "data.yaml")):
+            print(f"Dataset - {dataset} - is not valid")
+            exit()
+
+    if args["space"] is not None and not os.path.exists(args["space"]):
+        print(f"Search space - {args['space']} - does not exist")
+        exit()
+
+    os.makedirs(args["output"], exist_ok=True)
+
+    return args
+
+def _load_search_space(filename: str) -> dict:
+
+    space = dict(SEARCH_SPACE)
+
+    if filename is not None:
+        with open(filename, "r") as f:
+            space.update(json.load(f))
+
+    for name, values in space.items():
+
+        if name not in TRAINING_DEFAULTS and name != "percentage":
+            print(f"Parameter - {name} - can not be searched, choose from {', '.join(list(TRAINING_DEFAULTS) + ['percentage'])}")
+            exit()
+
+        # Plain values fix a parameter for every trial
+        if isinstance(values, dict) and "choices" not in values and not ("low" in values and "high" in values):
+            print(f"Search space of - {name} - needs either choices or low and high")
+            exit()
+
+    return space
+
+def _suggest(trial: optuna.Trial, name: str, values):
+
+    if not isinstance(values, dict):
+        return values
+
+    if "choices" in values:
+        return trial.suggest_categorical(name, values["choices"])
+
+    if all(isinstance(values.get(key, 1), int) for key in ["low", "high", "step"]):
+        return trial.suggest_int(name, values["low"], values["high"], step=values.get("step", 1), log=values.get("log", False))
+
+    return trial.suggest_float(name, values["low"], values["high"], step=values.get("step"), log=values.get("log", False))
+
+def _storage(program_arguments: dict) -> optuna.storages.RDBStorage:
+
+    # Trials of a killed search stop sending heartbeats and are failed when the search runs again
+    return optuna.storages.RDBStorage(
+        f"sqlite:///{os.path.join(program_arguments['output'], 'study.db')}",
+        engine_kwargs={"connect_args": {"timeout": 60}},
+        heartbeat_interval=60,
+        grace_period=180,
+    )
+
+def _run_stage(script: str, arguments: list, log) -> None:
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script)] + arguments
+
+    returncode = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode
+
+    if returncode != 0:
+        raise RuntimeError(f"{script} failed with exit code {returncode}, see {log.name}")
+
+def _dataset_variant(percentage: int, program_arguments: dict, lock) -> str:
+
+    variant = {"synthetic": program_arguments["synthetic"], "real": program_arguments["real"], "percentage": percentage, "view": program_arguments["view"]}
+
+    directory = os.path.join(program_arguments["output"], "datasets", _configuration_hash(variant))
+    dataset = os.path.join(directory, "dataset")
+
+    # A variant is finished once its description is written, so an interrupted build starts over
+    with lock:
+
+        if os.path.exists(os.path.join(directory, "variant.json")):
+            return dataset
+
+        print(f"Building dataset - {percentage}% of {program_arguments['synthetic']} and {program_arguments['real']}")
+
+        os.makedirs(directory, exist_ok=True)
+        downsampled = os.path.join(directory, "downsampled")
+
+        with open(os.path.join(directory, "build.log"), "w") as log:
+            _run_stage(DOWNSAMPLE_SCRIPT, ["-i", program_arguments["synthetic"], "-o", downsampled, "-p", str(percentage), "--view", program_arguments["view"]], log)
+            _run_stage(MERGE_SCRIPT, ["-a", downsampled, "-b", program_arguments["real"], "-o", dataset, "--view", program_arguments["view"]], log)
+
+        with open(os.path.join(directory, "variant.json"), "w") as f:
+            json.dump(variant, f, indent=2)
+
+    return dataset
+
+def _objective(trial: optuna.Trial, space: dict, device: str, program_arguments: dict, lock) -> float:
+
+    parameters = {name: _suggest(trial, name, values) for name, values in space.items()}
+
+    dataset = _dataset_variant(parameters.pop("percentage", 100), program_arguments, lock)
+    trial.set_user_attr("dataset", dataset)
+
+    training_arguments = dict(TRAINING_DEFAULTS)
+    training_arguments.update(parameters)
+    training_arguments.update({
+        "dataset": os.path.join(dataset, "data.yaml"),
+        "output": os.path.join(program_arguments["output"], "trials", f"{trial.number:04d}"),
+        # Only the last and best weights are kept, a search creates too many trainings for periodic checkpoints
+        "save_period": -1,
+        "batch": program_arguments["batch"],
+        "device": device,
+        "workers": program_arguments["workers"],
+        "threads": None,
+        "cache": None,
+        "autotune": False,
+        "seed": random.SystemRandom().randrange(2**32) if program_arguments["seed"] is None else program_arguments["seed"] + trial.number,
+    })
+
+    trial.set_user_attr("output", training_arguments["output"])
+
+    pruned_epoch = []
+
+    def report_epoch(trainer):
+
+        trial.report(float(trainer.metrics[METRIC]), trainer.epoch)
+
+        # Training ends cleanly after this epoch, the trial is marked as pruned once it returns
+        if trial.should_prune():
+            pruned_epoch.append(trainer.epoch)
+            trainer.stop = True
+
+    print(f"Starting trial {trial.number} - {json.dumps(trial.params, sort_keys=True)}")
+
+    metrics = train_YOLO_network._train_model(training_arguments, [("on_fit_epoch_end", report_epoch)])
+
+    if len(pruned_epoch) > 0:
+        raise optuna.TrialPruned(f"Trial {trial.number} pruned after epoch {pruned_epoch[0]}")
+
+    return float(metrics[METRIC])
+
+def _run_trials(job: int, space: dict, program_arguments: dict, lock) -> None:
+
+    # Parallel samplers would propose the same parameters without a seed of their own
+    seed = None if program_arguments["seed"] is None else program_arguments["seed"] + job
+
+    study = optuna.load_study(
+        study_name=program_arguments["study"],
+        storage=_storage(program_arguments),
+        sampler=optuna.samplers.TPESampler(seed=seed, constant_liar=True),
+        pruner=optuna.pruners.MedianPruner(n_startup_trials=program_arguments["startup_trials"], n_warmup_steps=program_arguments["warmup_epochs"]),
+    )
+
+    devices = program_arguments["devices"]
+    device = None if devices is None else devices[job % len(devices)]
+
+    # Every process stops once the study as a whole has enough trials
+    study.optimize(
+        lambda trial: _objective(trial, space, device, program_arguments, lock),
+        callbacks=[optuna.study.MaxTrialsCallback(program_arguments["trials"], states=FINISHED_STATES)],
+        catch=(Exception,),
+    )
+
+def _write_trials_table(study: optuna.Study, filename: str) -> None:
+
+    parameters = sorted(set(name for trial in study.trials for name in trial.params))
+    columns = ["trial", "state", METRIC] + parameters + ["epochs trained", "dataset"]
+
+    rows = []
+
+    for trial in study.trials:
+
+        row = {"trial": trial.number, "state": trial.state.name, METRIC: trial.value, "dataset": trial.user_attrs.get("dataset")}
+        row.update(trial.params)
+
+        if len(trial.intermediate_values) > 0:
+            row["epochs trained"] = max(trial.intermediate_values) + 1
+
+        rows.append(row)
+
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"Trials saved to - {filename}")
+
+def main():
+
+    program_arguments = _parse_arguments()
+
+    space = _load_search_space(program_arguments["space"])
+
+    study = optuna.create_study(study_name=program_arguments["study"], storage=_storage(program_arguments), direction="maximize", load_if_exists=True)
+
+    finished = sum(trial.state in FINISHED_STATES for trial in study.trials)
+
+    print(f"{finished} of {program_arguments['trials']} trials of study - {program_arguments['study']} - already finished")
+
+    if finished < program_arguments["trials"]:
+
+        # Every trial process gets a fresh CUDA context and the dataset variants are built by one process at a time
+        context = multiprocessing.get_context("spawn")
+        lock = context.Lock()
+
+        processes = [context.Process(target=_run_trials, args=(job, space, program_arguments, lock)) for job in range(program_arguments["jobs"])]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+    study = optuna.load_study(study_name=program_arguments["study"], storage=_storage(program_arguments))
+
+    _write_trials_table(study, os.path.join(program_arguments["output"], "trials.csv"))
+
+    completed = [trial for trial in study.trials if trial.state == optuna.trial.TrialState.COMPLETE]
+
+    if len(completed) == 0:
+        print("No trial completed yet")
+        return
+
+    best = study.best_trial
+
+    print(f"Best trial {best.number} - {METRIC} {_format_value(best.value)}")
+
+    for name, value in sorted(best.params.items()):
+        print(f"  {name}: {_format_value(value)}")
+
+    print(f"Weights of the best trial - {os.path.join(best.user_attrs['output'], 'train', 'weights', 'best.pt')}")
+
+if __name__ == "__main__" :
+    main()